@@ -0,0 +1,526 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tracemalloc
+import numpy as np
+import pylops
+import scipy.sparse
+from gradient_operators import gradient_x, gradient_y, gradient_z, FiniteDifference, Gradient3D, \
+    even_gradient_x, odd_gradient_x, even_gradient_y, odd_gradient_y
+from cpu_projector import dot_test
+from generator import random_volume, create_lamino_plates
+from object_scan import ScanningObject
+from proximal_operators import prox_l1, prox_l2s, prox_l1_inplace, prox_l2s_inplace, prox_box, prox_l1_pairs_inplace
+from proximal_solvers import PDHG, PDHG_inplace, operator_2norm, proximal_gradient, accelerated_proximal_gradient, \
+    estimate_operator_2norm, linearized_ADMM, TV_min_3D_GFB
+from inline_setup_3D import InlineScanningSetup
+from cpu_projector import ConeVecProjector
+from system_matrix import build_system_matrix
+
+
+def measure(function, *args, **kwargs):
+    """
+    Run function twice: once timed, once under tracemalloc for its peak memory.
+    :return: the result of the timed run and a dictionary with 'time' (s) and 'peak_memory' (bytes).
+    """
+    start_time = time.perf_counter()
+    result = function(*args, **kwargs)
+    elapsed_time = time.perf_counter() - start_time
+
+    tracemalloc.start()
+    function(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, {'time': elapsed_time, 'peak_memory': peak}
+
+
+def random_projection(shape, rays_per_voxel=2, voxels_per_ray=16, rng=None):
+    """
+    Random sparse stand-in for a projector of a volume of the given shape: every ray crosses voxels_per_ray random
+    voxels with random weights.
+    """
+    if rng is None:
+        rng = np.random.default_rng(0)
+    n = int(np.prod(shape))
+    m = rays_per_voxel * n
+    M = scipy.sparse.csr_matrix((rng.random(m * voxels_per_ray), rng.integers(0, n, m * voxels_per_ray),
+                                 np.arange(0, m * voxels_per_ray + 1, voxels_per_ray)), shape=(m, n))
+    return pylops.MatrixMult(M)
+
+
+def tv_problem(shape=(10, 64, 64), rays_per_voxel=2, voxels_per_ray=16, a=0.0025, seed=0, dtype=np.float64):
+    """
+    Synthetic version of the TV3D problem of ScanningObject.run: a random sparse projection W normalized to unit
+    norm, the z gradient D, and the data p of a piecewise constant volume. The operators compute in dtype, while the
+    norms and the data are computed in float64, so that the problems of both types only differ by their rounding.
+    :return: the stacked operator A = [W; D], the data p, the regularization weight a and the step size.
+    """
+    rng = np.random.default_rng(seed)
+    M = random_projection(shape, rays_per_voxel, voxels_per_ray, rng)
+    W_norm = estimate_operator_2norm(M, seed=seed)[0]
+    W = M * (1 / W_norm)
+
+    x = np.ones(shape) * 0.7
+    x[:, rng.integers(0, shape[1]):, :rng.integers(1, shape[2])] = 0.6
+
+    D = FiniteDifference(shape, 2)
+    A = pylops.VStack([W, D])
+    step = 0.9 ** 0.5 / (1.1 * estimate_operator_2norm(A, seed=seed)[0])
+    p = W @ x.ravel()
+
+    if np.dtype(dtype) != np.float64:
+        W = pylops.MatrixMult(M.A.astype(dtype), dtype=dtype) * (1 / W_norm)
+        A = pylops.VStack([W, FiniteDifference(shape, 2, dtype)], dtype=dtype)
+
+    return A, p, a, step
+
+
+def tv_pdhg(A, p, a, step, max_iter):
+    # the allocating formulation used by ScanningObject.run before PDHG_inplace
+    prox_f = lambda v, l: v
+    prox_l2l1 = lambda v, l: np.concatenate([prox_l2s(v[:p.size], l), prox_l1(v[p.size:], a * l)])
+    p0 = np.concatenate([p, np.zeros(A.shape[0] - p.size)])
+    prox_g = lambda v, l: p0 + prox_l2l1(v - p0, l)
+
+    return PDHG(prox_f, prox_g, A, np.zeros(A.shape[1]), np.zeros(A.shape[0]),
+                sigma=step, tau=step, theta=1, max_iter=max_iter, verbose=False)
+
+
+def tv_pdhg_inplace(A, p, a, step, max_iter, dtype=np.float64, tol=None, return_info=False):
+    n = p.size
+    p = p.astype(dtype)
+    work = np.empty(A.shape[0] - n, dtype=dtype)
+
+    def prox_f(v, l, out):
+        if out is not v:
+            np.copyto(out, v)
+
+    def prox_g(v, l, out):
+        np.subtract(v[:n], p, out=out[:n])
+        prox_l2s_inplace(out[:n], l, out[:n])
+        out[:n] += p
+        prox_l1_inplace(v[n:], a * l, out[n:], work)
+
+    return PDHG_inplace(prox_f, prox_g, A, np.zeros(A.shape[1], dtype=dtype), np.zeros(A.shape[0], dtype=dtype),
+                        sigma=step, tau=step, theta=1, max_iter=max_iter, verbose=False, tol=tol,
+                        return_info=return_info)
+
+
+def bench_pdhg(shapes=((10, 32, 32), (10, 64, 64), (10, 128, 128)), max_iter=20):
+    """
+    Per-iteration time and peak memory of PDHG against PDHG_inplace in float64 and float32, with operators of the
+    same type, and the relative difference of their results to PDHG.
+    """
+    results = []
+    for shape in shapes:
+        problem = tv_problem(shape)
+        reference, stats = measure(tv_pdhg, *problem, max_iter=max_iter)
+        results.append(dict(stats, case='PDHG', shape=shape, error=0.0))
+        for dtype in (np.float64, np.float32):
+            x, stats = measure(tv_pdhg_inplace, *tv_problem(shape, dtype=dtype), max_iter=max_iter, dtype=dtype)
+            error = np.linalg.norm(x - reference) / np.linalg.norm(reference)
+            results.append(dict(stats, case='PDHG_inplace {}'.format(np.dtype(dtype).name), shape=shape, error=error))
+
+    for r in results:
+        print("{:26s} {:14s} {:8.2f} ms/iter {:9.1f} MB peak   rel. diff {:.1e}".format(
+            r['case'], 'x'.join(map(str, r['shape'])), 1e3 * r['time'] / max_iter, r['peak_memory'] / 1e6, r['error']))
+    return results
+
+
+def bench_gradients(shape=(10, 128, 128), batch=4, repeat=10):
+    """
+    Time and peak memory of the forward and adjoint gradients, Kronecker products against stencils, with the largest
+    difference between their results and the adjoint error of the stencils.
+    """
+    rng = np.random.default_rng(0)
+    kronecker = [gradient_x(*shape), gradient_y(*shape), gradient_z(*shape)]
+    cases = [('gradient_x', kronecker[0], FiniteDifference(shape, 1)),
+             ('gradient_y', kronecker[1], FiniteDifference(shape, 0)),
+             ('gradient_z', kronecker[2], FiniteDifference(shape, 2)),
+             ('VStack([gx, gy, gz])', pylops.VStack(kronecker), Gradient3D(shape))]
+
+    def timing(function, x):
+        def repeated():
+            for _ in range(repeat):
+                function(x)
+        _, stats = measure(repeated)
+        return stats['time'] / repeat, stats['peak_memory']
+
+    results = []
+    for name, K, S in cases:
+        x = rng.standard_normal(K.shape[1])
+        y = rng.standard_normal(K.shape[0])
+        X = rng.standard_normal((K.shape[1], batch))
+        r = {'case': name, 'adjoint_error': dot_test(S, rng)}
+        for label, a, b in (('matvec', K @ x, S @ x), ('rmatvec', K.H @ y, S.H @ y)):
+            r['error_' + label] = np.abs(a - b).max()
+        for label, op in (('kronecker', K), ('stencil', S)):
+            for product, function, v in (('matvec', op.matvec, x), ('rmatvec', op.rmatvec, y),
+                                         ('matmat', op.matmat, X)):
+                r['{}_{}'.format(label, product)], r['{}_{}_peak_memory'.format(label, product)] = timing(function, v)
+        results.append(r)
+
+    for r in results:
+        print("{:22s} matvec {:7.2f} -> {:6.2f} ms, rmatvec {:7.2f} -> {:6.2f} ms, matmat({}) {:8.2f} -> {:6.2f} ms, "
+              "max diff {:.1e}, adjoint error {:.1e}".format(
+                r['case'], 1e3 * r['kronecker_matvec'], 1e3 * r['stencil_matvec'],
+                1e3 * r['kronecker_rmatvec'], 1e3 * r['stencil_rmatvec'], batch,
+                1e3 * r['kronecker_matmat'], 1e3 * r['stencil_matmat'],
+                max(r['error_matvec'], r['error_rmatvec']), r['adjoint_error']))
+    return results
+
+
+def bench_proximal_gradient(size=64, n_proj=4, tol=1e-3, max_iter=2000):
+    """
+    Iterations, time and peak memory for box-constrained least squares on the inline setup to reach tol,
+    proximal_gradient against accelerated_proximal_gradient with each restart scheme and with backtracking.
+    """
+    setup = InlineScanningSetup(alpha=30, detector_cells=2 * size, number_of_projections=n_proj, object_size=size)
+    W = ConeVecProjector(setup.get_geometry_matrix(), 2 * size, 2 * size, (10, size, size), cache_rays=True,
+                         dtype=np.float64)
+    x = np.zeros((10, size, size))
+    x[2:8, size // 8:7 * size // 8, size // 4:3 * size // 4] = 0.7
+    p = W @ x.ravel()
+
+    f = lambda x: 0.5 * np.sum(np.square(W @ x - p))
+    grad_f = lambda x: W.H @ (W @ x - p)
+    prox_g = lambda v, l: prox_box(v, l, (0, 1))
+    l = 1 / operator_2norm(W, 30) ** 2
+    x0 = np.zeros(W.shape[1])
+
+    cases = [('proximal_gradient', lambda: proximal_gradient(grad_f, prox_g, x0, l, max_iter, False, tol,
+                                                             return_info=True)),
+             ('FISTA, no restart', lambda: accelerated_proximal_gradient(grad_f, prox_g, x0, l, max_iter, False, tol,
+                                                                         return_info=True, restart=None)),
+             ('FISTA, gradient restart', lambda: accelerated_proximal_gradient(grad_f, prox_g, x0, l, max_iter, False,
+                                                                               tol, return_info=True)),
+             ('FISTA, function restart', lambda: accelerated_proximal_gradient(grad_f, prox_g, x0, l, max_iter, False,
+                                                                               tol, return_info=True,
+                                                                               restart="function", f=f)),
+             ('FISTA, backtracking', lambda: accelerated_proximal_gradient(grad_f, prox_g, x0, None, max_iter, False,
+                                                                           tol, return_info=True, f=f))]
+    results = []
+    for name, solve in cases:
+        (rec, info), stats = measure(solve)
+        results.append({'case': name, 'iterations': info['iterations'], 'converged': info['converged'],
+                        'time': info['time'], 'peak_memory': stats['peak_memory'], 'objective': f(rec)})
+        print("{:26s} {:5d} iterations {:8.2f} s  converged {}  objective {:.3e}".format(
+            name, info['iterations'], info['time'], info['converged'], results[-1]['objective']))
+    return results
+
+
+def _iterations_to(info, target):
+    # first check at which both residuals were below their target, None if never
+    for check, primal, dual in zip(info['checks'], info['primal_residual'], info['dual_residual']):
+        if primal <= target[0] and dual <= target[1]:
+            return check
+    return None
+
+
+def bench_warm_start(n_proj=4, sirt_iterations=(0, 1, 5, 20), tol=1e-2, max_iter=1000, seed=0):
+    """
+    Iterations of TV3D on a plate to bring its residuals below tol times the first residuals of the cold start,
+    starting from zero, from the normalized backprojection (1 SIRT iteration) and from a few SIRT iterations, with the
+    time of the warm start, the peak memory and the relative error of the reconstruction at max_iter.
+    """
+    plate = create_lamino_plates(1, rng=np.random.default_rng(seed), size=128)[0] * 255
+    setup = ScanningObject(alpha_param=30, n_cells_param=256, n_proj_param=n_proj, rec_size_param=128,
+                           backend_param='cpu')
+    setup.geometry.tv3d_sirt_weights()
+
+    results = []
+    target = None
+    for k in sirt_iterations:
+        out, stats = measure(setup.run, plate, 'TV3D', n_iterations_param=max_iter, sirt_iterations_param=k)
+        info = out['info']
+        if target is None:
+            target = (tol * info['primal_residual'][0], tol * info['dual_residual'][0])
+        iterations = _iterations_to(info, target)
+        error = np.linalg.norm(out['rec'] - plate / 255) / np.linalg.norm(plate / 255)
+        warm_time = info.get('warm_start', {}).get('time', 0.0)
+        results.append({'case': 'SIRT {}'.format(k) if k else 'zero', 'iterations': iterations,
+                        'warm_start_time': warm_time, 'time': out['time'], 'peak_memory': stats['peak_memory'],
+                        'error': error})
+        print("{:10s} {:>5s} iterations to the target residuals, warm start {:6.2f} s, total {:7.2f} s, "
+              "error {:.4f}".format(results[-1]['case'], str(iterations), warm_time, out['time'], error))
+    return results
+
+
+def bench_dtype(n_proj=4, n_iterations=200, batch=4, seed=0):
+    """
+    Time and peak memory of TV3D on a batch of plates generated, projected and solved in float32 against float64,
+    with the relative difference of the float32 reconstructions to the float64 ones and the relative error of both to
+    the plates.
+    """
+    results = []
+    reference = None
+    for dtype in (np.float64, np.float32):
+        plates = create_lamino_plates(batch, rng=np.random.default_rng(seed), size=128, dtype=dtype) * 255
+        setup = ScanningObject(alpha_param=30, n_cells_param=256, n_proj_param=n_proj, rec_size_param=128,
+                               backend_param='cpu')
+        outs, stats = measure(setup.run_batch, plates, n_iterations_param=n_iterations, dtype_param=dtype)
+        recs = np.stack([out['rec'] for out in outs])
+        if reference is None:
+            reference = recs
+        name = np.dtype(dtype).name
+        results.append({'case': name, 'time': outs[0]['time'] * batch, 'peak_memory': stats['peak_memory'],
+                        'dtype': str(recs.dtype),
+                        'difference': np.linalg.norm(recs - reference) / np.linalg.norm(reference),
+                        'error': np.linalg.norm(recs - plates / 255) / np.linalg.norm(plates / 255)})
+        print("{:8s} {:7.2f} s for {} plates, reconstructions in {}, difference to float64 {:.1e}, "
+              "error {:.4f}".format(name, results[-1]['time'], batch, recs.dtype, results[-1]['difference'],
+                                    results[-1]['error']))
+    return results
+
+
+def record(suite, case, size, stats, iterations=None, **extra):
+    """
+    One result of the benchmark suite: the suite and case names with the problem size identify it across runs.
+    """
+    if not isinstance(size, str):
+        size = 'x'.join(map(str, np.atleast_1d(size)))
+    return dict(extra, suite=suite, case=case, size=size, time=stats['time'], peak_memory=stats.get('peak_memory'),
+                iterations=iterations)
+
+
+def bench_generation(plate_batches=(16, 64), block_sizes=((24, 48, 12), (48, 96, 24), (96, 192, 48)), seed=0):
+    """
+    Time and peak memory of the generation of the samples: random_volume blocks and batches of plates.
+    """
+    results = []
+    for size in block_sizes:
+        _, stats = measure(random_volume, *size, rng=np.random.default_rng(seed))
+        results.append(record('generation', 'random_volume', size, stats))
+    for n in plate_batches:
+        _, stats = measure(create_lamino_plates, n, rng=np.random.default_rng(seed))
+        results.append(record('generation', 'create_lamino_plates', (n, 10, 256, 256), stats))
+    return results
+
+
+def bench_even_odd(sizes=(64, 128, 256), repeat=10):
+    """
+    Time of the even and odd differences of an n x n image, as the Kronecker operators of gradient_operators and as
+    the strided pair prox that replaced them in the TV proxes.
+    """
+    results = []
+    rng = np.random.default_rng(0)
+    for n in sizes:
+        x = rng.standard_normal(n * n)
+        for name, G in (('even_gradient_x', even_gradient_x(n)), ('odd_gradient_x', odd_gradient_x(n)),
+                        ('even_gradient_y', even_gradient_y(n)), ('odd_gradient_y', odd_gradient_y(n))):
+            y = rng.standard_normal(G.shape[0])
+            for label, function, v in (('matvec', G.matvec, x), ('rmatvec', G.rmatvec, y)):
+                _, stats = measure(lambda: [function(v) for _ in range(repeat)])
+                stats['time'] /= repeat
+                results.append(record('even_odd', '{} {}'.format(name, label), (n, n), stats))
+
+        image = x.reshape(n, n)
+        out = np.empty_like(image)
+        for axis, parity in ((1, 0), (1, 1), (0, 0), (0, 1)):
+            pairs = [n, n]
+            pairs[axis] = (n - parity) // 2
+            work = np.empty(pairs)
+            _, stats = measure(lambda: [prox_l1_pairs_inplace(image, 0.1, axis, parity, out, work)
+                                        for _ in range(repeat)])
+            stats['time'] /= repeat
+            results.append(record('even_odd', 'prox_l1_pairs_inplace axis {} parity {}'.format(axis, parity), (n, n),
+                                  stats))
+    return results
+
+
+def bench_operator_2norm(shapes=((10, 32, 32), (10, 64, 64), (10, 128, 128)), max_iter=20, tol=1e-4):
+    """
+    Time, peak memory and iterations of the 2-norm estimates of random projections: the fixed-iteration power
+    method of operator_2norm against estimate_operator_2norm with tol.
+    """
+    results = []
+    for shape in shapes:
+        W = random_projection(shape)
+        norm, stats = measure(operator_2norm, W, max_iter)
+        results.append(record('operator_2norm', 'operator_2norm', shape, stats, max_iter, norm=norm))
+        (norm, bound, iterations), stats = measure(estimate_operator_2norm, W, tol=tol, max_iter=100)
+        results.append(record('operator_2norm', 'estimate_operator_2norm', shape, stats, iterations, norm=norm))
+    return results
+
+
+def bench_projectors(n_projs=(4, 20), repeats=5):
+    """
+    Time and peak memory of the CPU projectors of the inline setup: the construction of the SystemMatrix, which the
+    'sparse' backend then loads from its cache, and the forward and adjoint products of ConeVecProjector with its ray
+    cache and of the SystemMatrix.
+    """
+    results = []
+    for n_proj in n_projs:
+        vectors = InlineScanningSetup(alpha=30, detector_cells=256, number_of_projections=n_proj,
+                                      object_size=128).get_geometry_matrix()
+        S, stats = measure(build_system_matrix, vectors, 256, 256, (10, 128, 128))
+        results.append(record('projectors', 'SystemMatrix build', n_proj, stats, nnz=S.matrix.nnz))
+
+        W = ConeVecProjector(vectors, 256, 256, (10, 128, 128), cache_rays=True)
+        x = np.random.default_rng(0).random(W.shape[1]).astype(np.float32)
+        y = W @ x
+        for name, op in (('ConeVecProjector', W), ('SystemMatrix', S)):
+            op.H @ y
+            for direction, product, v in (('forward', op.matvec, x), ('adjoint', op.rmatvec, y)):
+                def repeated():
+                    for i in range(repeats):
+                        product(v)
+                _, stats = measure(repeated)
+                stats['time'] /= repeats
+                results.append(record('projectors', '{} {}'.format(name, direction), n_proj, stats))
+                print("{:3d} projections {:28s} {:.4f} s".format(n_proj, results[-1]['case'], stats['time']))
+    return results
+
+
+def bench_solvers(shapes=((10, 32, 32), (10, 64, 64), (10, 128, 128)), max_iter=200, tol=1e-3):
+    """
+    Time, peak memory and iterations of the solvers on the synthetic TV problems of tv_problem: PDHG_inplace and
+    linearized_ADMM on the z gradient formulation of ScanningObject.run, stopped at tol, and GFB with the 3D
+    even/odd TV splitting for a fixed number of iterations.
+    """
+    results = []
+    for shape in shapes:
+        A, p, a, step = tv_problem(shape)
+        W = A.ops[0]
+        n = p.size
+
+        prox_f = lambda v, l: v
+        p0 = np.concatenate([p, np.zeros(A.shape[0] - n)])
+        prox_g = lambda v, l: p0 + np.concatenate([prox_l2s(v[:n] - p, l), prox_l1(v[n:], a * l)])
+
+        (_, info), stats = measure(tv_pdhg_inplace, A, p, a, step, max_iter, tol=tol, return_info=True)
+        results.append(record('solvers', 'PDHG_inplace', shape, stats, info['iterations'],
+                              converged=info['converged']))
+
+        l_g = 1.0
+        l_f = 0.9 * l_g / operator_2norm(A, 20) ** 2
+        (_, info), stats = measure(linearized_ADMM, prox_f, prox_g, A, np.zeros(A.shape[1]), np.zeros(A.shape[0]),
+                                   np.zeros(A.shape[0]), l_f, l_g, max_iter=max_iter, verbose=False, tol=tol,
+                                   return_info=True)
+        results.append(record('solvers', 'linearized_ADMM', shape, stats, info['iterations'],
+                              converged=info['converged']))
+
+        # W has unit norm, so the gradient of the data term is 1-Lipschitz
+        grad_f = lambda x: W.H @ (W @ x - p)
+        gfb_iter = max_iter // 4
+        _, stats = measure(TV_min_3D_GFB, grad_f, a, np.zeros(shape), 1.0, 1.0, max_iter=gfb_iter, verbose=False)
+        results.append(record('solvers', 'TV_min_3D_GFB', shape, stats, gfb_iter))
+    return results
+
+
+def _gradient_records(results, shape):
+    records = []
+    for r in results:
+        for label in ('kronecker', 'stencil'):
+            for product in ('matvec', 'rmatvec', 'matmat'):
+                key = '{}_{}'.format(label, product)
+                records.append(record('gradients', '{} {} {}'.format(r['case'], label, product), shape,
+                                      {'time': r[key], 'peak_memory': r[key + '_peak_memory']}))
+    return records
+
+
+def run_suite(quick=False):
+    """
+    Run all the benchmarks. quick=True drops the largest problem sizes, for a run of a few minutes.
+    :return: the list of records of all the cases.
+    """
+    shapes = ((10, 32, 32), (10, 64, 64)) if quick else ((10, 32, 32), (10, 64, 64), (10, 128, 128))
+    gradient_shape = (10, 64, 64) if quick else (10, 128, 128)
+
+    results = []
+    results += bench_generation(plate_batches=(16,) if quick else (16, 64))
+    results += _gradient_records(bench_gradients(gradient_shape), gradient_shape)
+    results += bench_even_odd((64, 128) if quick else (64, 128, 256))
+    results += bench_operator_2norm(shapes)
+    results += bench_projectors((4,) if quick else (4, 20))
+    for r in bench_pdhg(shapes):
+        results.append(record('pdhg', r['case'], r['shape'], r, 20, error=r['error']))
+    results += bench_solvers(shapes)
+    for r in bench_warm_start(max_iter=300 if quick else 1000):
+        results.append(record('warm_start', r['case'], 4, r, r['iterations'], error=r['error']))
+    for r in bench_dtype(n_iterations=100 if quick else 200):
+        results.append(record('dtype', r['case'], 4, r, 100 if quick else 200, difference=r['difference'],
+                              error=r['error']))
+    for r in bench_proximal_gradient(32 if quick else 64):
+        results.append(record('proximal_gradient', r['case'], 32 if quick else 64, r, r['iterations'],
+                              converged=r['converged']))
+    return results
+
+
+def environment():
+    """
+    Description of the machine and of the revision the benchmarks ran on.
+    """
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        revision = None
+    return {'revision': revision, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpu_count': os.cpu_count(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'scipy': scipy.__version__, 'pylops': pylops.__version__}
+
+
+def save_results(results, path):
+    with open(path, 'w') as file:
+        json.dump({'environment': environment(), 'results': results}, file, indent=1, default=float)
+
+
+def load_results(path):
+    with open(path) as file:
+        return json.load(file)['results']
+
+
+def compare_results(baseline, results, tolerance=0.25, min_time=1e-3):
+    """
+    Compare the results of a run with those of a baseline run, case by case.
+    A case regresses when its time or peak memory grows by more than tolerance (relative), or when its iterations
+    grow; times below min_time (s) in both runs are too noisy to be compared.
+    :return: the list of (suite, case, size, metric, baseline value, value) of the regressions.
+    """
+    key = lambda r: (r['suite'], r['case'], r['size'])
+    reference = {key(r): r for r in baseline}
+    regressions = []
+    for r in results:
+        b = reference.get(key(r))
+        if b is None:
+            continue
+        for metric in ('time', 'peak_memory', 'iterations'):
+            old, new = b.get(metric), r.get(metric)
+            if old is None or new is None:
+                continue
+            if metric == 'time' and max(old, new) < min_time:
+                continue
+            limit = old if metric == 'iterations' else old * (1 + tolerance)
+            ratio = new / old if old else float('inf')
+            flag = new > limit
+            if flag:
+                regressions.append(key(r) + (metric, old, new))
+            print("{:18s} {:44s} {:10s} {:12s} {:12.4g} -> {:12.4g} ({:5.2f}x){}".format(
+                r['suite'], r['case'], r['size'], metric, old, new, ratio, '  REGRESSION' if flag else ''))
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmarks of the generation, operators and solvers")
+    parser.add_argument("--output", default="benchmarks.json", help="JSON file the results are written to")
+    parser.add_argument("--compare", default=None, help="JSON results of a baseline run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="relative growth of time or peak memory reported as a regression")
+    parser.add_argument("--quick", action="store_true", help="skip the largest problem sizes")
+    args = parser.parse_args()
+
+    results = run_suite(args.quick)
+    save_results(results, args.output)
+    print("{} cases written to {}".format(len(results), args.output))
+
+    if args.compare is not None:
+        regressions = compare_results(load_results(args.compare), results, args.tolerance)
+        print("{} regressions".format(len(regressions)))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,200 @@
+import os
+import time
+import numpy as np
+from multiprocessing import Pool
+from volume_store import VolumeStore, is_volume_store, read_png_volume
+
+
+def _reduce_axes(ndim, axis):
+    axis = axis % ndim
+    return tuple(a for a in range(ndim) if a != axis)
+
+
+def column_mse(gt, rec, axis=-1):
+    """
+    It computes the MSE of every slice of the volumes along axis (the slices [:, :, z] for axis=-1) at once.
+    """
+    return np.mean(np.square(np.subtract(gt, rec, dtype=np.float64)), axis=_reduce_axes(gt.ndim, axis))
+
+
+def column_psnr(gt, rec, data_range=1.0, axis=-1, mse=None):
+    """
+    It computes the PSNR of every slice of the volumes along axis; mse can be given if it is already known.
+    """
+    if mse is None:
+        mse = column_mse(gt, rec, axis)
+    with np.errstate(divide='ignore'):
+        return 10 * np.log10(data_range ** 2 / mse)
+
+
+def _box_mean(x, win_size, axes):
+    # means over all the windows that fit entirely in x along axes, from cumulative sums
+    for axis in axes:
+        x = np.moveaxis(x, axis, 0)
+        c = np.zeros((x.shape[0] + 1,) + x.shape[1:])
+        np.cumsum(x, axis=0, out=c[1:])
+        x = np.moveaxis((c[win_size:] - c[:-win_size]) / win_size, 0, axis)
+    return x
+
+
+def column_ssim(gt, rec, data_range=1.0, axis=-1, win_size=7):
+    """
+    It computes the SSIM of every slice of the volumes along axis, with the uniform window and the constants of
+    skimage.metrics.structural_similarity. skimage averages over the windows that fit in the slice, so only those are
+    computed, for all the slices at once.
+    """
+    axis = axis % gt.ndim
+    axes = _reduce_axes(gt.ndim, axis)
+    gt = gt.astype(np.float64, copy=False)
+    rec = rec.astype(np.float64, copy=False)
+
+    ux, uy, uxx, uyy, uxy = _box_mean(np.stack([gt, rec, gt * gt, rec * rec, gt * rec]), win_size,
+                                      [a + 1 for a in axes])
+
+    # sample covariances, as skimage
+    n = win_size ** len(axes)
+    cov_norm = n / (n - 1)
+    vx = cov_norm * (uxx - ux * ux)
+    vy = cov_norm * (uyy - uy * uy)
+    vxy = cov_norm * (uxy - ux * uy)
+
+    c1 = (0.01 * data_range) ** 2
+    c2 = (0.03 * data_range) ** 2
+    s = ((2 * ux * uy + c1) * (2 * vxy + c2)) / ((ux ** 2 + uy ** 2 + c1) * (vx + vy + c2))
+    return np.mean(s, axis=axes)
+
+
+class RunningStats:
+    """
+    This class accumulates the mean and the variance of a stream of equally shaped arrays with Welford's algorithm,
+    so that the memory does not grow with the number of samples.
+    Attributes
+    ----------
+    count   : int
+        It holds the number of accumulated samples;
+    mean    : ndarray
+        It holds the running mean;
+    Methods
+    -------
+    update(x)
+        Adds a sample.
+    merge(other)
+        Adds the samples accumulated by another RunningStats.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if self.mean is None:
+            self.mean = np.zeros_like(x)
+            self.m2 = np.zeros_like(x)
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean.copy(), other.m2.copy()
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return np.zeros_like(self.mean)
+        return self.m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+def open_source(src):
+    """
+    It opens a dataset given as a VolumeStore or as a folder of PNG volumes.
+    :return: the sorted sample names and a function reading a sample volume by name.
+    """
+    if is_volume_store(src):
+        store = VolumeStore(src)
+        return sorted(store.names), lambda name: store[name]
+    return sorted(os.listdir(src)), lambda name: read_png_volume(os.path.join(src, name))
+
+
+# sources opened once per worker process
+_readers = None
+
+
+def _open_sources(src_gt, src_rec):
+    global _readers
+    _readers = (open_source(src_gt)[1], open_source(src_rec)[1])
+
+
+def _evaluate_sample(args):
+    name, scale, axis, metrics = args
+    read_gt, read_rec = _readers
+    gt = read_gt(name)
+    rec = read_rec(name)
+
+    # the scores of the volumes divided by scale, without dividing them
+    scores = {}
+    mse = column_mse(gt, rec, axis)
+    if 'mse' in metrics:
+        scores['mse'] = mse / scale ** 2
+    if 'psnr' in metrics:
+        scores['psnr'] = column_psnr(gt, rec, data_range=scale, axis=axis, mse=mse)
+    if 'ssim' in metrics:
+        scores['ssim'] = column_ssim(gt, rec, data_range=scale, axis=axis)
+    return scores
+
+
+def evaluate(src_gt, src_rec, names=None, axis=-1, scale=255, metrics=('mse', 'psnr', 'ssim'), workers=None,
+             chunksize=8):
+    """
+    It scores the reconstructions of a dataset against its ground truth, slice by slice along axis, reading every
+    pair of volumes once. The volumes are scored in parallel worker processes and only running statistics are kept.
+    :param src_gt: ground truth dataset, a VolumeStore or a folder of PNG volumes;
+    :param src_rec: reconstructed dataset, a VolumeStore or a folder of PNG volumes;
+    :param names: names of the samples to score (all the samples of src_gt if None);
+    :param axis: axis of the volumes along which the slices are scored;
+    :param scale: the volumes are divided by scale, so that their data range is 1;
+    :param metrics: metrics to compute, among 'mse', 'psnr' and 'ssim';
+    :param workers: number of worker processes (os.cpu_count() if None, 1 to score in this process);
+    :param chunksize: number of samples handed to a worker at once;
+    :return: a dictionary with a RunningStats of the per-slice scores for every metric.
+    """
+    if names is None:
+        names = open_source(src_gt)[0]
+    stats = {metric: RunningStats() for metric in metrics}
+    tasks = ((name, scale, axis, metrics) for name in names)
+
+    start_time = time.time()
+    if workers == 1:
+        _open_sources(src_gt, src_rec)
+        results = map(_evaluate_sample, tasks)
+        pool = None
+    else:
+        pool = Pool(workers, initializer=_open_sources, initargs=(src_gt, src_rec))
+        results = pool.imap_unordered(_evaluate_sample, tasks, chunksize=chunksize)
+
+    for scores in results:
+        for metric, value in scores.items():
+            stats[metric].update(value)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    elapsed_time = time.time() - start_time
+    print("{} samples in {:.1f} s ({:.1f} samples/s)".format(len(names), elapsed_time,
+                                                            len(names) / max(elapsed_time, 1e-9)))
+    return stats
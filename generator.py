@@ -5,10 +5,13 @@
 import numpy as np
 from skimage.draw import ellipse
 import matplotlib.pyplot as plt
-import random
 from imageio import imwrite
 import os
-from skimage.util import random_noise
+from multiprocessing import Pool
+from functools import lru_cache
+import time
+from tqdm import tqdm
+from volume_store import VolumeStoreWriter, png_scale
 
 def noise(size, lamb, cut):
 
@@ -34,64 +37,164 @@ def create_ellipsoid_hole(data, src, radius, slice, rot):
 
     return data
 
-def create_simple_lamino_set_of_holes():
+def create_lamino_plates(n, rng=None, n_slices=10, size=256, max_holes=10, max_radius=25, n_shells=4,
+                         background=0.7, hole=0.6, chunk_size=64, dtype=np.float64):
+    """
+    Generate a batch of laminography plates with ellipsoidal holes.
+
+    All holes of all plates are rasterized at once: the ellipse inequality is evaluated with broadcasting over a
+    (2*max_radius+1)^2 window around every hole center, the n_shells shells of each hole are resolved on the pixels
+    of the outer one and the covered voxels are written with fancy-index assignments. Pixels falling outside the
+    plate are dropped.
+    :param n: number of plates;
+    :param rng: numpy Generator used to draw the hole parameters (a new default_rng() if None);
+    :param n_slices: number of slices of each plate;
+    :param size: number W of pixels of the W x W slices;
+    :param max_holes: maximum number of holes per plate (at least one hole is created);
+    :param max_radius: maximum radius of a hole, in pixels;
+    :param n_shells: number of shells of decreasing radius stacked around the central slice of a hole;
+    :param background: value of the plate material;
+    :param hole: value written inside the holes;
+    :param chunk_size: number of plates rasterized per vectorized pass, bounding the temporary memory;
+    :param dtype: floating point type of the plates (np.float32 halves their memory);
+    :return: ndarray of shape (n, n_slices, size, size).
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    plates = np.full((n, n_slices, size, size), background, dtype=dtype)
+
+    nr_holes = rng.integers(1, max_holes, size=n, endpoint=True)
+    pos = rng.integers(0, size, size=(n, max_holes, 2))
+    radius = rng.integers(1, max_radius, size=(n, max_holes, 2), endpoint=True)
+    rot = np.deg2rad(rng.integers(0, 180, size=(n, max_holes), endpoint=True)) % np.pi
+    slices = rng.integers(0, n_slices, size=(n, max_holes))
+
+    # only the holes that exist, as flat (plate, hole) pairs
+    plate_idx, hole_idx = np.nonzero(np.arange(max_holes) < nr_holes[:, np.newaxis])
+    pos = pos[plate_idx, hole_idx]
+    radius = radius[plate_idx, hole_idx]
+    rot = rot[plate_idx, hole_idx]
+    slices = slices[plate_idx, hole_idx]
+
+    offsets = np.arange(-max_radius, max_radius + 1)
+    dr = offsets[:, np.newaxis]
+    dc = offsets[np.newaxis, :]
+
+    for start in range(0, plate_idx.size, chunk_size * max_holes):
+        chunk = slice(start, start + chunk_size * max_holes)
+
+        # rotated window coordinates of each hole, (holes, rows, cols)
+        cos_a = np.cos(rot[chunk])[:, np.newaxis, np.newaxis]
+        sin_a = np.sin(rot[chunk])[:, np.newaxis, np.newaxis]
+        u = dr * cos_a + dc * sin_a
+        w = dr * sin_a - dc * cos_a
+
+        # the shells share center and rotation and shrink, so they are nested: the outer one selects the
+        # candidate pixels and the inner ones only have to be evaluated there
+        r_rad = radius[chunk, 0, np.newaxis, np.newaxis]
+        c_rad = radius[chunk, 1, np.newaxis, np.newaxis]
+        h, i, j = np.nonzero(np.square(u / r_rad) + np.square(w / c_rad) < 1)
+        u, w = u[h, i, j], w[h, i, j]
+        h = h + start
+
+        # number of shells covering each candidate pixel
+        depth = np.ones(h.size, dtype=np.int64)
+        for s in range(1, n_shells):
+            r_rad = np.maximum(radius[h, 0] - 2 * s, 1)
+            c_rad = np.maximum(radius[h, 1] - 2 * s, 1)
+            depth += np.square(u / r_rad) + np.square(w / c_rad) < 1
+
+        rows = pos[h, 0] + offsets[i]
+        cols = pos[h, 1] + offsets[j]
+        keep = (rows >= 0) & (rows < size) & (cols >= 0) & (cols < size)
+        h, depth, rows, cols = h[keep], depth[keep], rows[keep], cols[keep]
+
+        # shell s covers slices slice-s and slice+s, so a pixel covered by `depth` shells is a hole in the
+        # slices within depth-1 of the central one
+        for dz in range(-(n_shells - 1), n_shells):
+            sel = depth > abs(dz)
+            z = np.clip(slices[h[sel]] + dz, 0, n_slices - 1)
+            plates[plate_idx[h[sel]], z, rows[sel], cols[sel]] = hole
+
+    return plates
+
+def create_simple_lamino_set_of_holes(n_plates=10000, batch_size=64, rng=None, store=False):
     dest = ".\\data_plates\\"
-    if not os.path.isdir(dest):
+    if rng is None:
+        rng = np.random.default_rng()
+
+    if store:
+        writer = VolumeStoreWriter(dest, (10, 256, 256), n_plates)
+    elif not os.path.isdir(dest):
         os.mkdir(dest)
 
-    for i in range(10000):
-        plane = np.ones((10, 256, 256)) * 0.7
+    for start in range(0, n_plates, batch_size):
+        planes = create_lamino_plates(min(batch_size, n_plates - start), rng=rng)
+
+        # the plates of samples already in the store are drawn all the same, so that the others do not change
+        for b, plane in enumerate(planes):
+            i = start + b
+            if store:
+                if "plate_{:05d}".format(i) not in writer:
+                    writer.append("plate_{:05d}".format(i), png_scale(plane))
+                continue
 
-        nr_holes = randint(1, 10)
+            if not os.path.isdir(dest + "plate_{:05d}".format(i)):
+                os.mkdir(dest + "plate_{:05d}".format(i))
 
-        for k in range(nr_holes):
-            random_posx = randint(0, 255)
-            random_posy = randint(0, 255)
+            for x in range(plane.shape[0]):
+                imwrite(dest + "plate_{:05d}\\slice_{}.png".format(i, x), plane[x, :, :])
 
-            random_radiusx = randint(1, 25)
-            random_radiusy = randint(1, 25)
+    if store:
+        writer.close()
 
-            random_rot = randint(0, 180)
-            random_slice = randint(0, 9)
-            create_hole(plane, src=(random_posx, random_posy), radius=(random_radiusx, random_radiusy), rot=random_rot,
-                        slice=random_slice)
 
-        if not os.path.isdir(dest + "plate_{:05d}".format(i)):
-            os.mkdir(dest + "plate_{:05d}".format(i))
 
-        for x in range(10):
-            imwrite(dest + "plate_{:05d}\\slice_{}.png".format(i, x), plane[x, :, :])
+@lru_cache(maxsize=None)
+def coordinate_grid(shape):
+    """
+    Pixel coordinates of a slice of the given shape, as the (x, y) axes of the grid the attachment masks are defined
+    on. They are computed once per shape and shared, so they are read-only.
+    """
+    y = np.uint16(np.linspace(0,shape[0],shape[0]))
+    x = np.uint16(np.linspace(0,shape[1],shape[1]))
+    x.flags.writeable = False
+    y.flags.writeable = False
 
+    return x, y
 
+def _grid_range(axis, low, high):
+    # indices of the (sorted) grid axis whose coordinates lie in [low, high]
+    return np.searchsorted(axis, low, side='left'), np.searchsorted(axis, high, side='right')
 
 def wood_floor_slice_circular_fit(slice, pos, radius):
-    size = np.shape(slice)
+    x, y = coordinate_grid(np.shape(slice))
 
-    y = np.uint16(np.linspace(0,size[0],size[0]))
-    x = np.uint16(np.linspace(0,size[1],size[1]))
+    # the disc is only rasterized inside its bounding box
+    c0, c1 = _grid_range(x, pos[0]-radius, pos[0]+radius)
+    r0, r1 = _grid_range(y, pos[1]-radius, pos[1]+radius)
 
-    xv, yv = np.meshgrid(x,y)
+    xv = x[c0:c1].astype(np.int64) - pos[0]
+    yv = y[r0:r1, np.newaxis].astype(np.int64) - pos[1]
 
-    slice[np.power(xv-pos[0],2)+np.power(yv-pos[1],2) <= np.power(radius,2)] = 0
+    slice[r0:r1, c0:c1][np.square(xv)+np.square(yv) <= np.power(radius,2)] = 0
 
     return slice, radius
 
 def wood_floor_slice_retangular_fit(plane, pos1, pos2):
-    size = np.shape(plane)
-
+    x, y = coordinate_grid(np.shape(plane))
 
-    y = np.uint16(np.linspace(0,size[0],size[0]))
-    x = np.uint16(np.linspace(0,size[1],size[1]))
+    c0, c1 = _grid_range(x, pos1[0], pos2[0])
+    r0, r1 = _grid_range(y, pos1[1], pos2[1])
 
-    xv, yv = np.meshgrid(x,y)
-
-    plane[np.logical_and(np.logical_and(np.logical_and(xv >= pos1[0], xv <= pos2[0]), yv >= pos1[1]), yv <=pos2[1])] = 0
+    plane[r0:r1, c0:c1] = 0
 
     return plane, pos1[0]
 
-def rect_attachment(slice, dim, pos):
+def rect_attachment(slice, dim, pos, rng):
     size = np.shape(slice)
-    x0 = max(0,size[1]-random.randint(2,6))
+    x0 = max(0,size[1]-int(rng.integers(2,6,endpoint=True)))
     y0 = max(0, size[0]-pos)
     x1 = size[1]
     y1 = y0 + dim
@@ -108,12 +211,15 @@ def circ_attachment(slice, dim, pos):
 
     return slice, radius
 
-def buid_circ_attachments(slice, number=1):
+def buid_circ_attachments(slice, number=1, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
     ydim, xdim = np.shape(slice)
 
     max_radius = 0
     for n in range(number):
-        slice, radius = circ_attachment(slice, random.randint(4,int(ydim/4)), random.randint(3, ydim-3))
+        slice, radius = circ_attachment(slice, int(rng.integers(4,int(ydim/4),endpoint=True)),
+                                        int(rng.integers(3, ydim-3, endpoint=True)))
         if radius > max_radius:
             max_radius = radius
 
@@ -125,12 +231,15 @@ def buid_circ_attachments(slice, number=1):
 
     return final, max_radius
 
-def build_rect_attachments(slice, number=1):
+def build_rect_attachments(slice, number=1, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
     ydim, xdim = np.shape(slice)
 
     xmin = xdim
     for n in range(number):
-        slice, x = rect_attachment(slice, random.randint(1,int(ydim/4)), random.randint(3, ydim-3))
+        slice, x = rect_attachment(slice, int(rng.integers(1,int(ydim/4),endpoint=True)),
+                                   int(rng.integers(3, ydim-3, endpoint=True)), rng)
         if x < xmin:
             xmin = x
 
@@ -143,42 +252,115 @@ def build_rect_attachments(slice, number=1):
     return final, xmin
 
 
-def random_volume(x,y,z):
-    base = np.ones((x,y,z))
+def pepper_mask(shape, rng, amount=0.05):
+    # "pepper" mode of skimage.util.random_noise applied to an image of ones, drawn from the given Generator:
+    # False where a pixel is peppered
+    return rng.random(shape) >= amount
+
 
+def random_volume(x,y,z, rng=None):
+    """
+    Random (x, y, z) block with rectangular attachments in its lower slices and circular ones in its upper slices.
+    :return: boolean ndarray, True where there is material.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
 
-    maskrect, xmin = build_rect_attachments(np.ones((x,y)), random.randint(1,4))
-    maskcirc, rad = buid_circ_attachments(np.ones((x,y)), random.randint(1,3))
+    maskrect, xmin = build_rect_attachments(np.ones((x,y)), int(rng.integers(1,4,endpoint=True)), rng)
+    maskcirc, rad = buid_circ_attachments(np.ones((x,y)), int(rng.integers(1,3,endpoint=True)), rng)
 
     m = min(rad,y-xmin)
 
-    for v in range(z):
-        if v < (z/2)-2:
-            base[:,:, v] = random_noise(base[:,:, v],mode="pepper")
-            base[:,:,v] = np.logical_and(maskrect, base[:,:,v])
-        elif v >= (z/2)+2:
-            base[:, :, v] = random_noise(base[:, :, v], mode="pepper")
-            base[:,:,v] = np.logical_and(maskcirc, base[:,:,v])
-        else:
-            base[:, :, v] = random_noise(base[:, :, v], mode="pepper")
-            base[:,0:m, v] = 0
+    # noise for the whole block in one draw, slice after slice as the slices are stacked along the last axis
+    base = np.ascontiguousarray(np.moveaxis(pepper_mask((z,x,y), rng), 0, -1))
+
+    # slices below z/2-2 get the rectangular attachments, slices from z/2+2 on the circular ones and the middle
+    # band is cleared up to the attachments
+    low = max(int(np.ceil(z/2-2)), 0)
+    high = max(int(np.ceil(z/2+2)), low)
+    base[:,:,:low] &= maskrect[:,:,np.newaxis]
+    base[:,:,high:] &= maskcirc[:,:,np.newaxis]
+    base[:,0:m,low:high] = False
 
     return base
 
+def sample_rng(seed, k):
+    """
+    Independent random generator of sample k, derived from the campaign seed with a SeedSequence spawn key, so that
+    sample k is the same whatever the number of workers or the order in which samples are produced.
+    """
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(k,)))
+
+def lamino_block(k, seed, dtype=np.float64):
+    block = np.zeros((32, 64, 16), dtype=dtype)
+    block[4:28, 8:56, 2:14] = random_volume(24, 48, 12, rng=sample_rng(seed, k))
+
+    return block
+
+def lamino_name(k):
+    return "lamino_{}".format(str(k).zfill(4))
+
+def _write_lamino_block(args):
+    k, seed, dest = args
+    block = lamino_block(k, seed)
+
+    folder = os.path.join(dest, lamino_name(k))
+    if not os.path.isdir(folder):
+        os.mkdir(folder)
+
+    for z in range(block.shape[2]):
+        imwrite(os.path.join(folder, "slice_{:02d}.png".format(z)), block[:,:,z])
+
+    return k
+
+def _build_lamino_block(args):
+    k, seed, _ = args
+    return k, png_scale(lamino_block(k, seed, np.float32))
+
+def generate_dataset(dest, n_samples, seed=0, first=0, workers=None, chunksize=16, store=False):
+    """
+    Generate the samples first, ..., n_samples-1 of a dataset of random_volume blocks over a process pool.
+    :param dest: folder in which a lamino_<k> folder is written for every sample, or the VolumeStore folder;
+    :param n_samples: index after the last sample to be generated;
+    :param seed: campaign seed, sample k is generated from sample_rng(seed, k);
+    :param first: index of the first sample, so that a campaign can be split in ranges;
+    :param workers: number of worker processes (os.cpu_count() if None, in-process if 1);
+    :param chunksize: number of sample indices sent to a worker at once;
+    :param store: if True, the samples are appended to a VolumeStore in dest instead of being written as PNG slices;
+    samples already in the store are skipped, so an interrupted run can be resumed;
+    :return: the throughput, in samples per second.
+    """
+    if store:
+        writer = VolumeStoreWriter(dest, (32, 64, 16), n_samples)
+        jobs = [(k, seed, dest) for k in range(first, n_samples) if lamino_name(k) not in writer]
+        worker = _build_lamino_block
+    else:
+        if not os.path.isdir(dest):
+            os.makedirs(dest)
+        jobs = [(k, seed, dest) for k in range(first, n_samples)]
+        worker = _write_lamino_block
+
+    start_time = time.time()
+    if workers == 1:
+        results = map(worker, jobs)
+    else:
+        pool = Pool(workers)
+        results = pool.imap_unordered(worker, jobs, chunksize=chunksize)
+    for result in tqdm(results, total=len(jobs)):
+        if store:
+            writer.append(lamino_name(result[0]), result[1])
+    if store:
+        writer.close()
+    if workers != 1:
+        pool.close()
+        pool.join()
+    elapsed_time = time.time() - start_time
+
+    throughput = len(jobs) / elapsed_time
+    print("{} samples in {:.1f} s ({:.1f} samples/s)".format(len(jobs), elapsed_time, throughput))
+
+    return throughput
+
 if __name__ == "__main__":
     src = "D:\\Datasets\\lamino_attachable\\"
-    for k in range(10000):
-
-        block = np.zeros((32, 64, 16))
-        v = random_volume(24,48,12)
-
-        block[4:28, 8:56, 2:14] = v
-
-        dest = "lamino_{}\\".format(str(k).zfill(4))
-
-        if not os.path.isdir(src+dest):
-            os.mkdir(src+dest)
-
-        for z in range(16):
-            imwrite("{}slice_{:02d}.png".format(src+dest, z), block[:,:,z])
-
+    generate_dataset(src, 10000)
@@ -13,11 +13,11 @@ class GradientOperator(LinearOperator):
             self.dtype = dtype
 
     def _matvec(self, x):
-        return np.diff(x.ravel())
+        return np.diff(x.ravel().astype(self.dtype, copy=False))
 
     def _rmatvec(self, x):
         x = x.ravel()
-        y = np.zeros(self.n)
+        y = np.zeros(self.n, dtype=self.dtype)
         y[1:-1] = -np.diff(x)
         y[0] = -x[0]
         y[-1] = x[-1]
@@ -35,14 +35,14 @@ class SquareGradientOperator(LinearOperator):
 
     def _matvec(self, x):
         x = x.ravel()
-        y = np.zeros(self.n)
+        y = np.zeros(self.n, dtype=self.dtype)
         y[1:] = np.diff(x)
         y[0] = x[0]
         return y
 
     def _rmatvec(self, x):
         x = x.ravel()
-        y = np.zeros(self.n)
+        y = np.zeros(self.n, dtype=self.dtype)
         y[:-1] = -np.diff(x)
         y[-1] = x[-1]
         return y
@@ -59,22 +59,103 @@ class SquareIntegralOperator(LinearOperator):
 
     def _matvec(self, x):
         x = x.ravel()
-        y = np.cumsum(x)
+        y = np.cumsum(x, dtype=self.dtype)
         return y
 
     def _rmatvec(self, x):
         x = x.ravel()
-        y = np.flip(np.cumsum(np.flip(x, 0)), 0)
+        y = np.flip(np.cumsum(np.flip(x, 0), dtype=self.dtype), 0)
         return y
 
-# semi orthogonal splitting
+class FiniteDifference(LinearOperator):
+    """
+    Forward differences along one axis of a volume, applied to the reshaped
+    volume at once; the adjoint is the matching (negative) divergence. Several
+    volumes can be given as the columns of a matrix. The products are computed
+    in dtype, so float32 operators keep float32 solvers in float32.
+    """
+    def __init__(self, shape, axis, dtype=None):
+        self.vol_shape = tuple(shape)
+        self.axis = axis
+        self.out_shape = tuple(n - 1 if i == axis else n for i, n in enumerate(self.vol_shape))
+        self.shape = (int(np.prod(self.out_shape)), int(np.prod(self.vol_shape)))
+        if dtype is None:
+            self.dtype = np.float64
+        else:
+            self.dtype = dtype
+
+    def _matmat(self, x):
+        x = x.reshape(self.vol_shape + (-1,)).astype(self.dtype, copy=False)
+        return np.diff(x, axis=self.axis).reshape(self.shape[0], -1)
+
+    def _rmatmat(self, y):
+        y = y.reshape(self.out_shape + (-1,))
+        x = np.zeros(self.vol_shape + y.shape[-1:], dtype=self.dtype)
+        x[_axis_slice(self.axis, None, -1)] -= y
+        x[_axis_slice(self.axis, 1, None)] += y
+        return x.reshape(self.shape[1], -1)
+
+    def _matvec(self, x):
+        return self._matmat(x).ravel()
+
+    def _rmatvec(self, y):
+        return self._rmatmat(y).ravel()
+
+
+class Gradient3D(LinearOperator):
+    """
+    Forward differences along several axes of a volume, stacked in a single
+    output vector. With the default axes (1, 0, 2) the output has the layout
+    of VStack([gradient_x, gradient_y, gradient_z]).
+    """
+    def __init__(self, shape, axes=(1, 0, 2), dtype=None):
+        if dtype is None:
+            self.dtype = np.float64
+        else:
+            self.dtype = dtype
+        self.ops = [FiniteDifference(shape, axis, self.dtype) for axis in axes]
+        self.vol_shape = tuple(shape)
+        self.offsets = np.cumsum([0] + [op.shape[0] for op in self.ops])
+        self.shape = (int(self.offsets[-1]), int(np.prod(self.vol_shape)))
+
+    def _matmat(self, x):
+        x = x.reshape(self.vol_shape + (-1,)).astype(self.dtype, copy=False)
+        y = np.empty((self.shape[0], x.shape[-1]), dtype=self.dtype)
+        for op, first, last in zip(self.ops, self.offsets[:-1], self.offsets[1:]):
+            # each difference is written straight into its block of the output
+            np.subtract(x[_axis_slice(op.axis, 1, None)], x[_axis_slice(op.axis, None, -1)],
+                        out=y[first:last].reshape(op.out_shape + (-1,)))
+        return y
+
+    def _rmatmat(self, y):
+        y = y.reshape(self.shape[0], -1)
+        x = np.zeros(self.vol_shape + y.shape[-1:], dtype=self.dtype)
+        for op, first, last in zip(self.ops, self.offsets[:-1], self.offsets[1:]):
+            block = y[first:last].reshape(op.out_shape + (-1,))
+            x[_axis_slice(op.axis, None, -1)] -= block
+            x[_axis_slice(op.axis, 1, None)] += block
+        return x.reshape(self.shape[1], -1)
+
+    def _matvec(self, x):
+        return self._matmat(x).ravel()
+
+    def _rmatvec(self, y):
+        return self._rmatmat(y).ravel()
+
+
+def _axis_slice(axis, start, stop):
+    return (slice(None),) * axis + (slice(start, stop),)
+
+
+# semi orthogonal splitting; GradientOperator is a scipy operator, which the pylops
+# Restriction can only be composed with once wrapped
 def even_gradient(n):
     even = pylops.Restriction(n - 1, np.arange(0, n-1, 2))
-    return even @ GradientOperator(n)
+    return even @ pylops.LinearOperator(GradientOperator(n))
 
 def odd_gradient(n):
     odd = pylops.Restriction(n - 1, np.arange(1, n-1, 2))
-    return odd @ GradientOperator(n)
+    return odd @ pylops.LinearOperator(GradientOperator(n))
 
 
 # 2D gradient operators
@@ -96,16 +177,16 @@ def gradient_z(a,b,c):
 # Semi-orthogonal splitting of 2D gradient operators
 def even_gradient_x(n):
     even = pylops.Restriction(n - 1, np.arange(0, n-1, 2))
-    return pylops.Kronecker(pylops.Identity(n), even @ GradientOperator(n))
+    return pylops.Kronecker(pylops.Identity(n), even @ pylops.LinearOperator(GradientOperator(n)))
 
 def odd_gradient_x(n):
     odd = pylops.Restriction(n - 1, np.arange(1, n-1, 2))
-    return pylops.Kronecker(pylops.Identity(n), odd @ GradientOperator(n))
+    return pylops.Kronecker(pylops.Identity(n), odd @ pylops.LinearOperator(GradientOperator(n)))
 
 def even_gradient_y(n):
     even = pylops.Restriction(n - 1, np.arange(0, n-1, 2))
-    return pylops.Kronecker(even @ GradientOperator(n), pylops.Identity(n))
+    return pylops.Kronecker(even @ pylops.LinearOperator(GradientOperator(n)), pylops.Identity(n))
 
 def odd_gradient_y(n):
     odd = pylops.Restriction(n - 1, np.arange(1, n-1, 2))
-    return pylops.Kronecker(odd @ GradientOperator(n), pylops.Identity(n))
\ No newline at end of file
+    return pylops.Kronecker(odd @ pylops.LinearOperator(GradientOperator(n)), pylops.Identity(n))
\ No newline at end of file
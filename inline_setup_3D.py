@@ -16,6 +16,8 @@ class InlineScanningSetup:
     -------
     get_geometry_matrix()
         Returns the geometry_matrix built by the class constructor.
+    get_binned_geometry_matrix(binning)
+        Returns the geometry_matrix for a detector binned by a factor binning.
     """
 
     def __init__(self, alpha, detector_cells, number_of_projections, object_size):
@@ -58,4 +60,16 @@ class InlineScanningSetup:
         It provides access to the inline CT setup built in the constructor method.
         :return: the attribute geometry_matrix
         """
-        return self.geometry_matrix
\ No newline at end of file
+        return self.geometry_matrix
+
+    def get_binned_geometry_matrix(self, binning):
+        """
+        It provides the inline CT setup with a detector of binning x binning cells, for the coarse levels of
+        multiresolution reconstructions: the source and the detector do not move and the vectors between the centers
+        of neighbouring detector pixels are binning times longer.
+        :param binning: integer binning factor;
+        :return: the binned geometry matrix
+        """
+        geometry_matrix = self.geometry_matrix.copy()
+        geometry_matrix[:, 6:12] *= binning
+        return geometry_matrix
@@ -1,5 +1,5 @@
 from inline_setup_3D import *
-import astra
+import atexit
 import time
 from imageio import imread, imwrite
 from matplotlib import pyplot as plt
@@ -9,8 +9,19 @@ from tomopy import shepp2d
 import pylops
 from gradient_operators import gradient_x, gradient_y, gradient_z
 from gradient_operators import even_gradient, odd_gradient
-from proximal_operators import prox_l1, prox_l2s
-from proximal_solvers import PDHG, operator_2norm
+from gradient_operators import FiniteDifference
+from proximal_operators import prox_l1, prox_l2s, prox_l1_inplace, prox_l2s_inplace
+from proximal_solvers import PDHG, PDHG_inplace, operator_2norm, cached_operator_2norm, operator_fingerprint
+from proximal_solvers import split_convergence_record, sirt_weights, SIRT
+from cpu_projector import ConeVecProjector
+from system_matrix import load_system_matrix
+from profiling import Profiler
+
+# ASTRA (and CUDA) is only needed by the 'astra' backend
+try:
+    import astra
+except ImportError:
+    astra = None
 
 
 # optomo fix
@@ -18,14 +29,227 @@ def _matvec(self,v):
     return self.FP(v.ravel(), out=None).ravel()
 def _rmatvec(self,s):
     return self.BP(s.ravel(), out=None).ravel()
-astra.OpTomo._matvec = _matvec
-astra.OpTomo._rmatvec = _rmatvec
+if astra is not None:
+    astra.OpTomo._matvec = _matvec
+    astra.OpTomo._rmatvec = _rmatvec
+
+# pylops VStack applies matrices column by column, which defeats batched projections
+def _vstack_matmat(self, X):
+    return np.vstack([op.matmat(X) for op in self.ops])
+def _vstack_rmatmat(self, Y):
+    return sum(op.rmatmat(Y[self.nnops[i]:self.nnops[i + 1]]) for i, op in enumerate(self.ops))
+pylops.VStack._matmat = _vstack_matmat
+pylops.VStack._rmatmat = _vstack_rmatmat
+
+class ScanningGeometry:
+    """
+    This class holds everything of a reconstruction that only depends on the scanning geometry, so that it can be
+    shared by all the volumes scanned with that geometry.
+    Attributes
+    ----------
+    setup       : InlineScanningSetup
+        It holds the scanning geometry;
+    vol_geom    : dict
+        It holds the characteristics of the reconstruction volume ('astra' backend);
+    proj_geom   : dict
+        It holds the projection geometry ('astra' backend);
+    projector   : ConeVecProjector or SystemMatrix
+        It holds the CPU projector ('cpu' backend) or the cached system matrix ('sparse' backend);
+    vol_shape   : tuple
+        It holds the shape of the (binned) reconstruction volume;
+    Methods
+    -------
+    tv3d_operators(dtype=np.float64)
+        Returns the operators and the step size normalization of TV3D for solver buffers of type dtype, built on first
+        use.
+    sirt_weights()
+        Returns the SIRT weights of the projector ('cpu' and 'sparse' backends), computed on first use.
+    tv3d_sirt_weights()
+        Returns the SIRT weights of the normalized projector of TV3D, computed on first use.
+    release()
+        Deletes the ASTRA objects created for this geometry.
+    """
+
+    def __init__(self, alpha, n_cells, n_proj, rec_size, backend, binning=1):
+        """
+        It creates a new instance of the class ScanningGeometry, with the parameters of ScanningObject.
+        :param binning: the rows and columns of the volume and of the detector are binned by this factor, for the coarse
+        levels of multiresolution reconstructions (the detector cells must be a multiple of it); the slices are kept,
+        as there are few of them and the depth is what laminography resolves worst;
+        """
+        self.backend = backend
+        self.binning = binning
+        self.params = {'alpha': alpha, 'n_cells': n_cells, 'n_proj': n_proj, 'rec_size': rec_size, 'backend': backend}
+        if binning != 1:
+            self.params['binning'] = binning
+        self.setup = InlineScanningSetup(alpha=alpha, detector_cells=n_cells,
+                                         number_of_projections=n_proj, object_size=rec_size)
+
+        # the binned volume covers the whole volume, up to a partial voxel at its borders
+        self.voxel_size = (1, binning, binning)
+        self.vol_shape = tuple(-(-n // b) for n, b in zip((10, 128, 128), self.voxel_size))
+        self.n_cells = n_cells // binning
+        vectors = self.setup.get_binned_geometry_matrix(binning)
+
+        if self.backend == 'astra':
+            half = [n * b / 2 for n, b in zip(self.vol_shape, self.voxel_size)]
+            self.vol_geom = astra.create_vol_geom(self.vol_shape[1], self.vol_shape[2], self.vol_shape[0],
+                                                  -half[2], half[2], -half[1], half[1], -half[0], half[0])
+            self.proj_geom = astra.create_proj_geom('cone_vec', self.n_cells, self.n_cells, vectors)
+        elif self.backend == 'sparse':
+            self.projector = load_system_matrix(vectors, self.n_cells, self.n_cells, self.vol_shape,
+                                                voxel_size=self.voxel_size)
+        else:
+            self.projector = ConeVecProjector(vectors, self.n_cells, self.n_cells, self.vol_shape, cache_rays=True,
+                                              voxel_size=self.voxel_size)
+
+        self.projector_id = None
+        self.W = None
+        self.tv3d = {}
+        self.sirt = None
+        self.tv3d_sirt = None
+        self.W_norm = None
+
+    def tv3d_operators(self, dtype=np.float64):
+        """
+        It builds, on first use, the normalized projection operator W, the gradient operator D, the stacked operator
+        A = [W; D] and the norm of A used for the PDHG step sizes. Both norms are looked up in the on-disk cache of
+        cached_operator_2norm, keyed by the geometry parameters; the norm of the projector is kept in W_norm.
+        :param dtype: type of the solver buffers: D and A compute their products in their own type, so they are built
+        for every dtype (W and the norms are shared);
+        :return: the tuple (W, D, A, op_norm).
+        """
+        dtype = np.dtype(dtype)
+        if dtype not in self.tv3d:
+            if self.W is None:
+                if self.backend == 'astra':
+                    self.projector_id = astra.create_projector('cuda3d', self.proj_geom, self.vol_geom)
+                    W = astra.optomo.OpTomo(self.projector_id)
+                else:
+                    W = self.projector
+                W_norm, _ = cached_operator_2norm(W, operator_fingerprint(W.shape, operator='W', **self.params),
+                                                 tol=1e-3)
+                self.W = W * (1 / W_norm)
+                self.W_norm = W_norm
+            W = self.W
+
+            # gradient operator
+            # gradient_z(10,128,128), applied as a stencil instead of Kronecker products
+            D = FiniteDifference(self.vol_shape, axis=2, dtype=dtype)
+            # D = D*(1/operator_2norm(W, max_iter=20))
+            # the stacked operator we will use in lin ADMM
+            A = pylops.VStack([W, D], dtype=dtype)
+
+            A_norm, _ = cached_operator_2norm(A, operator_fingerprint(A.shape, operator='[W; D_z]', **self.params),
+                                             tol=1e-3)
+            op_norm = 1.1 * A_norm
+            print(op_norm)
+
+            self.tv3d[dtype] = (W, D, A, op_norm)
+
+        return self.tv3d[dtype]
+
+    def sirt_weights(self):
+        if self.sirt is None:
+            if self.backend == 'sparse':
+                self.sirt = self.projector.sirt_weights()
+            else:
+                self.sirt = sirt_weights(self.projector)
+        return self.sirt
+
+    def tv3d_sirt_weights(self):
+        if self.tv3d_sirt is None:
+            W = self.tv3d_operators()[0]
+            if self.backend == 'astra':
+                self.tv3d_sirt = sirt_weights(W)
+            else:
+                # the row and column sums of W are those of the projector divided by W_norm
+                R, C = self.sirt_weights()
+                self.tv3d_sirt = (self.W_norm * R, self.W_norm * C)
+        return self.tv3d_sirt
+
+    def release(self):
+        if self.projector_id is not None:
+            astra.projector3d.delete(self.projector_id)
+            self.projector_id = None
+        self.W = None
+        self.tv3d = {}
+        self.sirt = None
+        self.tv3d_sirt = None
+
+
+class GeometryCache:
+    """
+    This class shares ScanningGeometry instances between ScanningObject instances with the same geometry. The cached
+    geometries own ASTRA projectors, which are deleted by clear(), when leaving a with block, or at exit for the
+    module-level geometry_cache.
+    Methods
+    -------
+    get(alpha, n_cells, n_proj, rec_size, backend, binning=1)
+        Returns the geometry for these parameters, creating it if needed.
+    clear()
+        Releases and forgets all the cached geometries.
+    """
+
+    def __init__(self):
+        self.geometries = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.clear()
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def get(self, alpha, n_cells, n_proj, rec_size, backend, binning=1):
+        key = (alpha, n_cells, n_proj, rec_size, backend, binning)
+        if key not in self.geometries:
+            self.geometries[key] = ScanningGeometry(alpha, n_cells, n_proj, rec_size, backend, binning)
+        return self.geometries[key]
+
+    def clear(self):
+        for geometry in self.geometries.values():
+            geometry.release()
+        self.geometries.clear()
+
+
+geometry_cache = GeometryCache()
+atexit.register(geometry_cache.clear)
+
+
+def bin_sinogram(p, sino_shape, binning):
+    """
+    It averages the sinogram p, flattened from sino_shape (detector rows, projections, detector cols), over blocks of
+    binning x binning detector pixels. Several sinograms can be given as columns.
+    """
+    rows, n_proj, cols = sino_shape
+    binned = p.reshape(rows // binning, binning, n_proj, cols // binning, binning, -1).mean(axis=(1, 4))
+    return binned.reshape((-1,) + p.shape[1:])
+
+
+def upsample_volume(x, shape, voxel_size, out_shape, out_voxel_size):
+    """
+    It resamples the volume x, flattened from shape, to the finer grid of out_shape: every voxel of the fine grid takes
+    the value of the coarse voxel containing its center (both grids are centered on the origin, with voxels of
+    voxel_size and out_voxel_size). Several volumes can be given as columns.
+    """
+    index = []
+    for n, b, m, c in zip(shape, voxel_size, out_shape, out_voxel_size):
+        centers = (np.arange(m) + 0.5 - m / 2) * c
+        index.append(np.clip(np.floor(centers / b + n / 2).astype(int), 0, n - 1))
+    up = x.reshape(shape + (-1,))[np.ix_(*index)]
+    return up.reshape((-1,) + x.shape[1:])
+
 
 class ScanningObject:
     """
     This class defines an inline scanning geometry and executes image reconstructions.
     Attributes
     ----------
+    geometry    : ScanningGeometry
+        It holds the (shared) scanning geometry and reconstruction operators;
     proj_geom   : dict
         It holds the projection geometry to be used;
     setup       : ndarray
@@ -36,46 +260,88 @@ class ScanningObject:
     -------
     run(phantom_param, rec_algorithm_param='SIRT_CUDA', n_iterations_param=100)
         It executes an image reconstruction using the projections acquired in the inline setup.
+    run_batch(phantoms_param, n_iterations_param=100)
+        It executes TV3D reconstructions of several phantoms in a single solver run.
+    solve_tv3d_multires(p, levels_param)
+        It solves TV3D from coarse to fine grids.
     """
 
-    def __init__(self, alpha_param, n_cells_param, n_proj_param, rec_size_param=256):
+    def __init__(self, alpha_param, n_cells_param, n_proj_param, rec_size_param=256, backend_param='astra',
+                 cache_param=None):
         """
         It creates a new instance of the class ScanningExecution.
         :param alpha_param: fan-beam opening angle of the X-ray source used in the inline CT setup;
         :param n_cells_param: number of detector elements used in the inline CT setup;
         :param n_proj_param: number of X-ray projections aquired during the object movement;
         :param rec_size_param: number W of pixels of the W x W reconstruction grid;
+        :param backend_param: 'astra' to project with ASTRA on the GPU, 'cpu' to use ConeVecProjector, or 'sparse' to
+        use the system matrix of the geometry, built once and cached on disk (see load_system_matrix), which is much
+        faster than 'cpu' for the few projections of the inline setup; the CPU backends support TV3D and SIRT3D
+        reconstructions;
+        :param cache_param: GeometryCache the geometry is taken from (the module-level geometry_cache if None);
 
         acquisition.
         """
 
-        self.vol_geom = astra.create_vol_geom(128, 128, 10)
-
-        self.setup = InlineScanningSetup(alpha=alpha_param, detector_cells=n_cells_param,
-                                         number_of_projections=n_proj_param, object_size=rec_size_param)
-
-        self.proj_geom = astra.create_proj_geom('cone_vec', n_cells_param, n_cells_param, self.setup.get_geometry_matrix())
-
-    def run(self, phantom_param, rec_algorithm_param='SIRT3D_CUDA', n_iterations_param=100):
+        self.backend = backend_param
+        if self.backend == 'astra' and astra is None:
+            raise ImportError("the 'astra' backend needs ASTRA Toolbox, use backend_param='cpu' or 'sparse' without it")
+
+        if cache_param is None:
+            cache_param = geometry_cache
+        self.cache = cache_param
+        self.geometry_params = (alpha_param, n_cells_param, n_proj_param, rec_size_param, self.backend)
+        self.geometry = cache_param.get(*self.geometry_params)
+
+        self.setup = self.geometry.setup
+        if self.backend == 'astra':
+            self.vol_geom = self.geometry.vol_geom
+            self.proj_geom = self.geometry.proj_geom
+        else:
+            self.projector = self.geometry.projector
+
+    def run(self, phantom_param, rec_algorithm_param='SIRT3D_CUDA', n_iterations_param=100, dtype_param=np.float64,
+            tol_param=None, check_every_param=10, profile_param=False, levels_param=None, sirt_iterations_param=0):
         """
         It executes an image reconstruction using the projections acquired in the inline setup.
         :param phantom_param: 3D volume of the phantom that should be used to simulate the acquisition of projections from
         real object;
         :param rec_algorithm_param: reconstruction algorithm to be used. The option available are: SIRT_CUDA and FBP_CUDA;
-        :param n_iterations_param: number of iterations to be used in case of iterative reconstructions;
+        SIRT3D runs SIRT on the CPU backends;
+        :param n_iterations_param: number of iterations to be used in case of iterative reconstructions (the maximum
+        number of iterations of TV3D when tol_param is given);
+        :param dtype_param: floating point type of the TV3D solver buffers (np.float32 halves their memory traffic);
+        :param tol_param: TV3D stops once its primal and dual residuals are below tol_param times their first value;
+        :param check_every_param: number of TV3D iterations between two residual checks;
+        :param profile_param: if True, the calls of TV3D to the projector W, the gradient D, the stacked operator A and
+        the proximal operators are counted and timed;
+        :param levels_param: sequence of (binning, n_iterations, tol) levels of a multiresolution TV3D reconstruction,
+        from the coarsest to the full grid (binning 1), e.g. [(2, 200, None), (1, 50, None)];
+        n_iterations_param and tol_param are then ignored (see solve_tv3d_multires);
+        :param sirt_iterations_param: number of SIRT iterations whose result TV3D starts from (from the first level
+        with levels_param); 1 starts from the normalized backprojection, 0 from zero;
         :return: a dictionary containing the reconstructed image into 'rec' index, the reconstruction time into 'time' index,
-        and the acquired sinogram into the 'sino' index;
+        and the acquired sinogram into the 'sino' index; TV3D adds its convergence record (iterations used, residual
+        histories, converged) into the 'info' index, and the report of the profiler into the 'profile' index when
+        profile_param is True;
         """
 
 
-        #proj_id = astra.create_projector('cuda', self.proj_geom, self.vol_geom)
-        proj_id, proj_data = astra.create_sino3d_gpu(phantom_param, self.proj_geom, self.vol_geom)
+        supported = ('SIRT3D_CUDA', 'TV3D') if self.backend == 'astra' else ('SIRT3D', 'TV3D')
+        if rec_algorithm_param not in supported:
+            raise ValueError("the {} backend does not support {}".format(self.backend, rec_algorithm_param))
+
+        if self.backend == 'astra':
+            #proj_id = astra.create_projector('cuda', self.proj_geom, self.vol_geom)
+            proj_id, proj_data = astra.create_sino3d_gpu(phantom_param, self.proj_geom, self.vol_geom)
 
-        #plt.figure("sino")
-        #plt.imshow(proj_data[:,5,:])
-        #plt.show()
+            #plt.figure("sino")
+            #plt.imshow(proj_data[:,5,:])
+            #plt.show()
 
-        rec_id = astra.data3d.create('-vol', self.vol_geom)
+            rec_id = astra.data3d.create('-vol', self.vol_geom)
+        else:
+            proj_data = (self.projector @ phantom_param.ravel()).reshape(self.projector.sino_shape)
 
 
         if rec_algorithm_param == 'SIRT3D_CUDA':
@@ -92,58 +358,221 @@ class ScanningObject:
 
             output = {'rec': astra.data3d.get(rec_id), 'time': elapsed_time, 'sino': proj_data}
 
-        elif rec_algorithm_param == 'TV3D':
-            projector_id = astra.create_projector('cuda3d', self.proj_geom, self.vol_geom)
-
-            W = astra.optomo.OpTomo(projector_id)
-            W = W * (1 / operator_2norm(W, max_iter=20))
-
-            phantom_param = phantom_param/255
-            p = W @ phantom_param.ravel()
+        elif rec_algorithm_param == 'SIRT3D':
+            weights = self.geometry.sirt_weights()
 
-            #a = 0.0025
-            a = 0.0025
-
-            # gradient operator
-            i, j, k = gradient_x(10,128,128), gradient_y(10,128,128), gradient_z(10,128,128)
-            D = k
-            #D = pylops.VStack([j, k])
-            # D = D*(1/operator_2norm(W, max_iter=20))
-            # the stacked operator we will use in lin ADMM
-            A = pylops.VStack([W, D])
+            start_time = time.time()
+            rec = SIRT(self.projector, proj_data.ravel(), max_iter=n_iterations_param, weights=weights)
+            elapsed_time = time.time() - start_time
 
-            # proximal of zero function is identity
-            prox_f = lambda v, l: v
+            output = {'rec': rec.reshape(phantom_param.shape), 'time': elapsed_time, 'sino': proj_data}
 
-            # proximal of g
-            prox_l2l1 = lambda v, l: np.concatenate([prox_l2s(v[:p.size], l), prox_l1(v[p.size:], a * l)])
-            p0 = np.concatenate([p, np.zeros(D.shape[0])])
-            prox_g = lambda v, l: p0 + prox_l2l1(v - p0, l)
+        elif rec_algorithm_param == 'TV3D':
+            W = self.geometry.tv3d_operators()[0]
 
-            op_norm = 1.1 * operator_2norm(A, 20)
-            print(op_norm)
-            sigma = tau = 0.9 ** 0.5 / op_norm
+            phantom_param = phantom_param.astype(dtype_param)/255
+            p = W @ phantom_param.ravel()
 
+            profiler = Profiler() if profile_param else None
             start_time = time.time()
-            rec = PDHG(prox_f, prox_g, A,
-                       np.zeros(phantom_param.size),
-                       np.zeros(A.shape[0]),
-                       sigma=sigma, tau=tau, theta=1,
-                       max_iter=200)
+            if levels_param is None:
+                rec, info = self.solve_tv3d(p, n_iterations_param, dtype_param, tol_param, check_every_param, profiler,
+                                            sirt_iterations=sirt_iterations_param)
+            else:
+                rec, info = self.solve_tv3d_multires(p, levels_param, dtype_param, check_every_param, profiler,
+                                                     sirt_iterations_param)
 
             rec = rec.reshape(phantom_param.shape)
             elapsed_time = time.time() - start_time
-            output = {'rec': rec, 'time': elapsed_time, 'sino': proj_data}
+            output = {'rec': rec, 'time': elapsed_time, 'sino': proj_data, 'info': info}
+            if profiler is not None:
+                output['profile'] = profiler.report(elapsed_time)
 
 
 
 
-        astra.data3d.delete(rec_id)
-        astra.data3d.delete(proj_id)
+        if self.backend == 'astra':
+            astra.data3d.delete(rec_id)
+            astra.data3d.delete(proj_id)
 
 
         return output
 
+    def run_batch(self, phantoms_param, n_iterations_param=100, dtype_param=np.float64, tol_param=None,
+                  check_every_param=10, profile_param=False, levels_param=None, sirt_iterations_param=0):
+        """
+        It executes TV3D reconstructions of several phantoms at once: the phantoms are the columns of a single PDHG
+        problem, so that every projection and backprojection is applied to all of them together.
+        :param phantoms_param: sequence of 3D phantom volumes (or a 4D array with the phantoms along the first axis);
+        :param n_iterations_param: maximum number of iterations;
+        :param dtype_param: floating point type of the solver buffers, whose size grows linearly with the number of
+        phantoms;
+        :param tol_param: the iterations stop once the residuals of every phantom are below tol_param times their first
+        value;
+        :param check_every_param: number of iterations between two residual checks;
+        :param profile_param: if True, the solver calls are profiled as in run;
+        :param levels_param: levels of a multiresolution reconstruction, as in run;
+        :param sirt_iterations_param: number of SIRT iterations of the warm start, as in run;
+        :return: a list with the output dictionary of run for each phantom; 'time' is the time of the whole batch
+        divided by the number of phantoms, 'info' is the convergence record of that phantom and 'profile', with
+        profile_param, the report of the whole batch.
+        """
+        phantoms_param = np.asarray(phantoms_param)
+        k = phantoms_param.shape[0]
+        X = phantoms_param.reshape(k, -1).T
+
+        if self.backend == 'astra':
+            sinos = []
+            for phantom in phantoms_param:
+                proj_id, proj_data = astra.create_sino3d_gpu(phantom, self.proj_geom, self.vol_geom)
+                astra.data3d.delete(proj_id)
+                sinos.append(proj_data)
+        else:
+            sinos = (self.projector @ X).T.reshape((k,) + self.projector.sino_shape)
+
+        W = self.geometry.tv3d_operators()[0]
+        P = W @ (X.astype(dtype_param) / 255)
+
+        profiler = Profiler() if profile_param else None
+        start_time = time.time()
+        if levels_param is None:
+            rec, info = self.solve_tv3d(P, n_iterations_param, dtype_param, tol_param, check_every_param, profiler,
+                                        sirt_iterations=sirt_iterations_param)
+        else:
+            rec, info = self.solve_tv3d_multires(P, levels_param, dtype_param, check_every_param, profiler,
+                                                 sirt_iterations_param)
+        elapsed_time = (time.time() - start_time) / k
+
+        recs = rec.T.reshape(phantoms_param.shape)
+        infos = split_convergence_record(info, k)
+        outputs = [{'rec': recs[i], 'time': elapsed_time, 'sino': sinos[i], 'info': infos[i]} for i in range(k)]
+        if profiler is not None:
+            report = profiler.report(elapsed_time * k)
+            for output in outputs:
+                output['profile'] = report
+        return outputs
+
+    def solve_tv3d(self, p, n_iterations_param=100, dtype_param=np.float64, tol_param=None, check_every_param=10,
+                   profiler=None, geometry=None, x0=None, sirt_iterations=0):
+        """
+        It solves the TV3D problem min_x 1/2||Wx - p||^2 + a||D_z x||_1 with the in-place PDHG.
+        :param p: projections of the phantom by the normalized operator W, or projections of several phantoms as
+        columns;
+        :param profiler: Profiler recording the products with W, D and A and the proximal operators;
+        :param geometry: ScanningGeometry of W and D (the geometry of this object if None);
+        :param x0: initial reconstruction (zeros if None); the dual variable starts from one dual step at x0. As a
+        warm start lowers the first residuals, tol_param is then relative to the first residuals of check_every_param
+        iterations from zero;
+        :param sirt_iterations: if x0 is None, the initial reconstruction is the result of this many nonnegative SIRT
+        iterations from zero, whose number and time are added to the convergence record as 'warm_start';
+        :return: the reconstruction (one column per phantom for a batch) and the convergence record.
+        """
+        if geometry is None:
+            geometry = self.geometry
+        W, D, A, op_norm = geometry.tv3d_operators(dtype_param)
+        p = p.astype(dtype_param)
+
+        warm_start = None
+        if x0 is None and sirt_iterations > 0:
+            start_time = time.perf_counter()
+            x0 = SIRT(W, p, max_iter=sirt_iterations, bounds=(0, None), weights=geometry.tv3d_sirt_weights())
+            warm_start = {'sirt_iterations': sirt_iterations, 'time': time.perf_counter() - start_time}
+        if profiler is not None:
+            # a stack of the profiled blocks, so that W and D are timed apart from the whole of A
+            A = pylops.VStack([profiler.operator('W', W), profiler.operator('D', D)], dtype=dtype_param)
+        n = p.shape[0]
+
+        #a = 0.0025
+        a = 0.0025
+
+        # proximal of zero function is identity
+        def prox_f(v, l, out):
+            if out is not v:
+                np.copyto(out, v)
+
+        # proximal of g, in place: p0 + prox_l2l1(v - p0, l) with p0 = [p, 0]
+        work = np.empty((D.shape[0],) + p.shape[1:], dtype=dtype_param)
+        def prox_g(v, l, out):
+            np.subtract(v[:n], p, out=out[:n])
+            prox_l2s_inplace(out[:n], l, out[:n])
+            out[:n] += p
+            prox_l1_inplace(v[n:], a * l, out[n:], work)
+
+        sigma = tau = 0.9 ** 0.5 / op_norm
+
+        y0 = np.zeros((A.shape[0],) + p.shape[1:], dtype=dtype_param)
+        tol_reference = None
+        if x0 is None:
+            x0 = np.zeros((A.shape[1],) + p.shape[1:], dtype=dtype_param)
+        else:
+            if tol_param is not None:
+                cold = PDHG_inplace(prox_f, prox_g, A, np.zeros_like(x0, dtype=dtype_param), y0, sigma=sigma, tau=tau,
+                                    theta=1, max_iter=check_every_param, verbose=False,
+                                    check_every=check_every_param, return_info=True, profiler=profiler)[1]
+                tol_reference = {name: cold[name][0] for name in ('primal_residual', 'dual_residual')}
+
+            # the dual variable of PDHG after one step from y = 0 with the primal variable at x0
+            x0 = x0.astype(dtype_param)
+            v = sigma * (A @ x0)
+            prox_g(v / sigma, 1 / sigma, y0)
+            y0 = (v - sigma * y0).astype(dtype_param)
+
+        x, info = PDHG_inplace(prox_f, prox_g, A, x0, y0,
+                               sigma=sigma, tau=tau, theta=1,
+                               max_iter=n_iterations_param,
+                               tol=tol_param, check_every=check_every_param, return_info=True, profiler=profiler,
+                               tol_reference=tol_reference)
+        if warm_start is not None:
+            info['warm_start'] = warm_start
+        return x, info
+
+    def solve_tv3d_multires(self, p, levels_param, dtype_param=np.float64, check_every_param=10, profiler=None,
+                            sirt_iterations=0):
+        """
+        It solves the TV3D problem from coarse to fine grids. At each level the rows and columns of the volume and of
+        the detector are binned by the level factor, the sinogram p is binned accordingly and the problem is solved
+        from the upsampled result of the previous level, so that the full grid only has to refine a reconstruction
+        whose piecewise constant structure is already resolved. A binning of 2 works best for the plates: coarser
+        grids are too blocky for the holes, and laminography hardly corrects the errors they leave.
+        :param p: projections of the phantom by the normalized operator W of the full grid, or projections of several
+        phantoms as columns;
+        :param levels_param: sequence of (binning, n_iterations, tol) from the coarsest level to the full grid, whose
+        binning must be 1; the binnings must decrease and divide the detector cells; the iterations of a level stop
+        after n_iterations or once its residuals are below tol times their first value (never if tol is None);
+        :param sirt_iterations: number of SIRT iterations the first level starts from, as in solve_tv3d;
+        :return: the reconstruction and the convergence record of the full grid, with the binning, iterations and
+        time of every level in its 'levels' index.
+        """
+        binnings = [level[0] for level in levels_param]
+        if binnings[-1] != 1 or any(b <= c for b, c in zip(binnings, binnings[1:])):
+            raise ValueError("the binnings {} do not decrease to 1".format(binnings))
+
+        full = self.geometry
+        full.tv3d_operators()
+        sino_shape = (full.n_cells, self.setup.get_geometry_matrix().shape[0], full.n_cells)
+
+        levels = []
+        x = None
+        previous = None
+        for binning, n_iterations, tol in levels_param:
+            geometry = self.cache.get(*self.geometry_params, binning=binning)
+            geometry.tv3d_operators()
+            if binning == 1:
+                p_level = p
+            else:
+                # both projectors are normalized by their norm
+                p_level = bin_sinogram(p, sino_shape, binning) * (full.W_norm / geometry.W_norm)
+            if x is not None:
+                x = upsample_volume(x, previous.vol_shape, previous.voxel_size, geometry.vol_shape, geometry.voxel_size)
+
+            x, info = self.solve_tv3d(p_level, n_iterations, dtype_param, tol, check_every_param, profiler, geometry, x,
+                                      sirt_iterations if x is None else 0)
+            levels.append({'binning': binning, 'iterations': info['iterations'], 'time': info['time']})
+            previous = geometry
+
+        info['levels'] = levels
+        return x, info
+
 
 if __name__ == '__main__':
 
@@ -174,4 +603,4 @@ if __name__ == '__main__':
 
     plt.show()
 
-   # plt.show()
\ No newline at end of file
+   # plt.show()
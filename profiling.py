@@ -0,0 +1,105 @@
+import json
+import time
+import threading
+import numpy as np
+from scipy.sparse.linalg import LinearOperator
+
+
+class Profiler:
+    """
+    This class records, for every named component of a solver run, i.e. an operator or a proximal operator, the
+    number of calls, the cumulative time and the bytes of the new arrays it returned. The solvers take it as their
+    profiler parameter and wrap their callables with it; without a profiler nothing is wrapped, so profiling costs
+    nothing when it is disabled.
+    Attributes
+    ----------
+    stats   : dict
+        It holds the 'calls', 'time' (s) and 'bytes' of every component, by name;
+    Methods
+    -------
+    function(name, f)
+        Returns f, recorded under name.
+    operator(name, A)
+        Returns the linear operator A, its products recorded under "name forward" and "name adjoint".
+    report(total_time=None)
+        Returns the statistics of the components, sorted by decreasing time.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        # GFB calls the proximal operators from several threads
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, nbytes):
+        with self.lock:
+            stats = self.stats.setdefault(name, {'calls': 0, 'time': 0.0, 'bytes': 0})
+            stats['calls'] += 1
+            stats['time'] += seconds
+            stats['bytes'] += nbytes
+
+    def call(self, name, f, *args, **kwargs):
+        start_time = time.perf_counter()
+        result = f(*args, **kwargs)
+        elapsed_time = time.perf_counter() - start_time
+
+        # results written into one of the arguments (in-place proximal operators) were not allocated by the call
+        nbytes = 0
+        if isinstance(result, np.ndarray) and not any(isinstance(a, np.ndarray) and np.may_share_memory(result, a)
+                                                      for a in args + tuple(kwargs.values())):
+            nbytes = result.nbytes
+        self.record(name, elapsed_time, nbytes)
+        return result
+
+    def function(self, name, f):
+        return lambda *args, **kwargs: self.call(name, f, *args, **kwargs)
+
+    def operator(self, name, A):
+        return ProfiledOperator(A, name, self)
+
+    def report(self, total_time=None):
+        """
+        :param total_time: duration of the run; if given, the share of every component is added as 'fraction'.
+        Nested components (the blocks of a profiled stacked operator) are part of the time of the stack.
+        :return: a dictionary of the statistics of the components, sorted by decreasing time.
+        """
+        report = {}
+        for name, stats in sorted(self.stats.items(), key=lambda item: -item[1]['time']):
+            report[name] = dict(stats, time_per_call=stats['time'] / stats['calls'])
+            if total_time:
+                report[name]['fraction'] = stats['time'] / total_time
+        return report
+
+    def print_report(self, total_time=None):
+        for name, stats in self.report(total_time).items():
+            print("{:24s} {:7d} calls {:9.3f} s {:9.3f} ms/call {:10.1f} MB{}".format(
+                name, stats['calls'], stats['time'], 1e3 * stats['time_per_call'], stats['bytes'] / 1e6,
+                "  {:5.1f} %".format(100 * stats['fraction']) if 'fraction' in stats else ""))
+
+    def save(self, path, total_time=None):
+        with open(path, 'w') as file:
+            json.dump(self.report(total_time), file, indent=1)
+
+
+class ProfiledOperator(LinearOperator):
+    """
+    Linear operator applying A and recording its products in a Profiler: the forward products (matvec and matmat)
+    as "name forward" and the adjoint ones as "name adjoint".
+    """
+    def __init__(self, A, name, profiler):
+        self.A = A
+        self.name = name
+        self.profiler = profiler
+        self.shape = A.shape
+        self.dtype = A.dtype
+
+    def _matvec(self, x):
+        return self.profiler.call(self.name + " forward", self.A.matvec, x)
+
+    def _rmatvec(self, y):
+        return self.profiler.call(self.name + " adjoint", self.A.rmatvec, y)
+
+    def _matmat(self, X):
+        return self.profiler.call(self.name + " forward", self.A.matmat, X)
+
+    def _rmatmat(self, Y):
+        return self.profiler.call(self.name + " adjoint", self.A.rmatmat, Y)
@@ -21,6 +21,35 @@ def prox_l2s(v, l):
     # proximal operator of  1/2||.||_2^2
     return 1/(1+l)*v
 
+# In-place variants: the result is written into out, which may be v itself.
+# work is an optional preallocated buffer of the shape of v.
+
+def prox_l1_inplace(v, l, out, work=None):
+    # soft thresholding as v - clip(v, -l, l)
+    work = np.clip(v, -l, l, out=work)
+    return np.subtract(v, work, out=out)
+
+def prox_l2s_inplace(v, l, out):
+    return np.multiply(v, 1/(1+l), out=out)
+
+def prox_l1_pairs_inplace(v, l, axis, parity, out, work=None):
+    # proximal operator of ||D.||_1, where D takes the differences of the
+    # disjoint pairs (parity, parity+1), (parity+2, parity+3), ... along axis
+    # of the array v: each pair is moved towards its mean by at most l.
+    # This is prox_f_semi_orthogonal(prox_l1, 2**(-0.5)*D, v, 2**(0.5)*l)
+    # computed on strided views, without applying D.
+    if out is not v:
+        np.copyto(out, v)
+    n = v.shape[axis]
+    p = out[(slice(None),) * axis + (slice(parity, n - 1, 2),)]
+    q = out[(slice(None),) * axis + (slice(parity + 1, n, 2),)]
+    c = np.subtract(q, p, out=work)
+    c *= 0.5
+    np.clip(c, -l, l, out=c)
+    p += c
+    q -= c
+    return out
+
 def prox_f_orthogonal(prox_f, A, v, l):
     # proximal operator of f(A), given the proximal operator
     # of f and given the orthogonal operator A (i.e. A.H @ A = A @ A.H = I)
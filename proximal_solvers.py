@@ -1,33 +1,217 @@
+import os
+import json
+import time
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from tqdm import tqdm
-from proximal_operators import prox_l1, prox_f_semi_orthogonal, prox_box
-from gradient_operators import (even_gradient_x,
-                                odd_gradient_x,
-                                even_gradient_y,
-                                odd_gradient_y)
+from scipy.sparse.linalg import eigsh
+from proximal_operators import prox_box, prox_l1_pairs_inplace
 
-def proximal_gradient(grad_f, prox_g, x0, l, max_iter=50, verbose=True):
+def _convergence_record():
+    return {"iterations": 0, "converged": False, "time": 0.0, "checks": []}
+
+def _is_check(i, max_iter, check_every):
+    return (i + 1) % check_every == 0 or i + 1 == max_iter
+
+def _check_convergence(info, i, tol, residuals, reference=None):
+    """
+    Append the residuals of iteration i to the convergence record and tell
+    whether all of them, except the gap, fell below tol times their first value
+    (or their value in the reference dictionary, if given)
+
+    For a batch of problems solved as the columns of x, the residuals hold one
+    value per column; every column is checked on its own and the iterations at
+    which the columns converged are kept in info["converged_at"] (0 if not yet).
+    """
+    info["checks"].append(i + 1)
+    converged = tol is not None
+    for name, value in residuals.items():
+        value = np.asarray(value, dtype=float)
+        history = info.setdefault(name, [])
+        history.append(value.tolist())
+        if name != "gap" and tol is not None:
+            first = reference[name] if reference is not None and name in reference else history[0]
+            converged = np.logical_and(converged, value <= tol*np.asarray(first))
+    if np.ndim(converged):
+        converged_at = info.setdefault("converged_at", np.zeros(converged.shape, dtype=int))
+        converged_at[(converged_at == 0) & converged] = i + 1
+        info["converged"] = converged
+    else:
+        info["converged"] = bool(converged)
+    return bool(np.all(converged))
+
+def _profile_solver(profiler, A=None, **callables):
+    # wraps A and the callables given by name for the profiler, if any;
+    # lists of callables (the proximal operators of GFB) are wrapped one by one
+    if profiler is None:
+        return (A,) + tuple(callables.values())
+    if A is not None:
+        A = profiler.operator("A", A)
+    wrapped = []
+    for name, f in callables.items():
+        if isinstance(f, (list, tuple)):
+            wrapped.append([profiler.function("{}[{}]".format(name, j), fj) for j, fj in enumerate(f)])
+        else:
+            wrapped.append(profiler.function(name, f))
+    return (A,) + tuple(wrapped)
+
+
+def split_convergence_record(info, n):
+    """
+    Split the convergence record of a batch of n problems into one record per problem
+
+    The iterations, times and levels (of multiresolution runs) are shared.
+    """
+    records = []
+    for k in range(n):
+        record = {"iterations": info["iterations"], "time": info["time"], "checks": info["checks"]}
+        if "levels" in info:
+            record["levels"] = info["levels"]
+        for name, value in info.items():
+            if name not in record:
+                if isinstance(value, list):
+                    record[name] = [h[k] for h in value]
+                else:
+                    # without tol, converged stays a single False for the whole batch
+                    record[name] = value[k] if np.ndim(value) else value
+        record["converged"] = bool(record["converged"])
+        records.append(record)
+    return records
+
+def proximal_gradient(grad_f, prox_g, x0, l, max_iter=50, verbose=True,
+                      tol=None, check_every=10, return_info=False, profiler=None):
     """
     Solve
 
         argmin_x f(x) + g(x)
 
     given the gradient of f and the proximal operator of g
+
+    Every check_every iterations the residual ||x_k - x_{k+1}||/l is recorded;
+    with tol, the iterations stop once it is below tol times its first value.
+    With return_info, the convergence record is returned along with x.
+    profiler (a profiling.Profiler) records the calls to grad_f and prox_g.
     """
+    _, grad_f, prox_g = _profile_solver(profiler, grad_f=grad_f, prox_g=prox_g)
     x = x0
+    monitor = tol is not None or return_info
+    info = _convergence_record()
+    start_time = time.perf_counter()
     if verbose:
         loop = tqdm(range(max_iter))
     else:
         loop = range(max_iter)
     for i in loop:
+        x_prev = x
         x = prox_g(x - l*grad_f(x), l)
+        info["iterations"] = i + 1
+        if monitor and _is_check(i, max_iter, check_every):
+            if _check_convergence(info, i, tol, {"residual": np.linalg.norm(x_prev - x, axis=0)/l}):
+                break
+    info["time"] = time.perf_counter() - start_time
+    if return_info:
+        return x, info
+    return x
+
+def accelerated_proximal_gradient(grad_f, prox_g, x0, l=None, max_iter=50, verbose=True,
+                                  tol=None, check_every=10, return_info=False,
+                                  restart="gradient", f=None, g=None, l_init=1.0, eta=0.5, profiler=None):
+    """
+    Solve
+
+        argmin_x f(x) + g(x)
+
+    given the gradient of f and the proximal operator of g, as
+    proximal_gradient, with Nesterov momentum (FISTA)
+
+    The momentum is restarted when it points against the descent direction
+    (restart="gradient"), when the objective f + g increases (restart="function",
+    which needs f, and g unless it is an indicator), or never (restart=None).
+    If the step l (1/Lipschitz constant of grad f) is None, it is found by
+    backtracking from l_init, shrinking it by eta until the quadratic upper
+    bound of f holds, which needs f. tol, check_every and return_info work as
+    in proximal_gradient; the record also holds the number of restarts and the
+    final step. profiler records the calls to grad_f, prox_g and f.
+    """
+    if l is None and f is None:
+        raise ValueError("backtracking needs f")
+    if restart == "function" and f is None:
+        raise ValueError("function restart needs f")
+    if restart not in ("gradient", "function", None):
+        raise ValueError("unknown restart {}".format(restart))
+
+    if f is not None:
+        _, grad_f, prox_g, f = _profile_solver(profiler, grad_f=grad_f, prox_g=prox_g, f=f)
+    else:
+        _, grad_f, prox_g = _profile_solver(profiler, grad_f=grad_f, prox_g=prox_g)
+
+    backtracking = l is None
+    if backtracking:
+        l = l_init
+    objective = lambda x: f(x) + (g(x) if g is not None else 0)
+
+    x = x0
+    y = x0
+    t = 1
+    F = objective(x) if restart == "function" else None
+    monitor = tol is not None or return_info
+    info = _convergence_record()
+    info["restarts"] = 0
+    start_time = time.perf_counter()
+    if verbose:
+        loop = tqdm(range(max_iter))
+    else:
+        loop = range(max_iter)
+    for i in loop:
+        grad = grad_f(y)
+        x_new = prox_g(y - l*grad, l)
+        if backtracking:
+            f_y = f(y)
+            while True:
+                d = x_new - y
+                if f(x_new) <= f_y + np.vdot(grad, d) + np.vdot(d, d)/(2*l):
+                    break
+                l *= eta
+                x_new = prox_g(y - l*grad, l)
+
+        if restart == "gradient":
+            restarted = np.vdot(y - x_new, x_new - x) > 0
+        elif restart == "function":
+            F_new = objective(x_new)
+            restarted = F_new > F
+            F = F_new
+        else:
+            restarted = False
+
+        if restarted:
+            t = 1
+            y = x_new
+            info["restarts"] += 1
+        else:
+            t_new = (1 + np.sqrt(1 + 4*t**2))/2
+            y = x_new + ((t - 1)/t_new)*(x_new - x)
+            t = t_new
+        x_prev = x
+        x = x_new
+
+        info["iterations"] = i + 1
+        if monitor and _is_check(i, max_iter, check_every):
+            if _check_convergence(info, i, tol, {"residual": np.linalg.norm(x_prev - x, axis=0)/l}):
+                break
+    info["time"] = time.perf_counter() - start_time
+    info["step"] = l
+    if return_info:
+        return x, info
     return x
 
 def linearized_ADMM(prox_f, prox_g, A,
                     x0, z0, u0,
                     l_f, l_g,
                     max_iter=50,
-                    verbose=True):
+                    verbose=True,
+                    tol=None, check_every=10, return_info=False, profiler=None):
     """
     Solve
     
@@ -35,10 +219,18 @@ def linearized_ADMM(prox_f, prox_g, A,
 
     given the proximal operators of f and g, and the linear operator A
     using the Linearized Alternating Direction Method of Multipliers
+
+    Every check_every iterations the primal residual ||Ax - z|| and the dual
+    residual ||A^H (z_k - z_{k+1})||/l_g are recorded, at the cost of one
+    extra product with A^H; tol, return_info and profiler work as in PDHG.
     """
+    A, prox_f, prox_g = _profile_solver(profiler, A, prox_f=prox_f, prox_g=prox_g)
     x = x0
     z = z0
     u = u0
+    monitor = tol is not None or return_info
+    info = _convergence_record()
+    start_time = time.perf_counter()
     if verbose:
         loop = tqdm(range(max_iter))
     else:
@@ -46,15 +238,27 @@ def linearized_ADMM(prox_f, prox_g, A,
     for i in loop:
         Ax = A @ x
         x = prox_f(x - (l_f/l_g)*A.H @ (Ax - z + u),l_f)
+        z_prev = z
         z = prox_g(Ax + u,l_g)
         u = u + Ax - z
+        info["iterations"] = i + 1
+        if monitor and _is_check(i, max_iter, check_every):
+            residuals = {"primal_residual": np.linalg.norm(Ax - z, axis=0),
+                         "dual_residual": np.linalg.norm(A.H @ (z_prev - z), axis=0)/l_g}
+            if _check_convergence(info, i, tol, residuals):
+                break
+    info["time"] = time.perf_counter() - start_time
+    if return_info:
+        return x, info
     return x
 
 def PDHG(prox_f, prox_g, A,
          x0, y0,
          sigma, tau, theta,
          max_iter=50,
-         verbose=True):
+         verbose=True,
+         tol=None, check_every=10, return_info=False,
+         f=None, g=None, f_conj=None, g_conj=None, profiler=None, tol_reference=None):
     """
     Solve
     
@@ -62,23 +266,178 @@ def PDHG(prox_f, prox_g, A,
 
     given the proximal operators of f and g, and the linear operator A
     using Primal Dual Hybrid Gradient
+
+    Every check_every iterations the primal residual ||x_k - x_{k+1}||/tau and
+    the dual residual ||(y_k - y_{k+1})/sigma - A(x_{k+1} - z_k)|| are recorded,
+    at the cost of one extra product with A. If f, g and their conjugates are
+    all given, the primal-dual gap f(x) + g(Ax) + f*(-A^H y) + g*(y) is
+    recorded as well. With tol, the iterations stop once both residuals are
+    below tol times their first value. With return_info, x is returned along
+    with the convergence record: iterations used, converged, time, the
+    iterations at which the residuals were checked and their histories.
+    A warm start lowers the first residuals, so that the same tol asks for
+    more; tol_reference, a dictionary of "primal_residual" and
+    "dual_residual" values (e.g. the first ones of a start from zero), then
+    replaces them.
+
+    Problems that share A can be solved together by passing their x0 and y0
+    as the columns of 2D arrays, so that A is applied to all of them at once
+    (the proximal operators then get 2D arrays as well). The residuals are
+    tracked per column and the iterations stop once every column converged;
+    split_convergence_record gives the record of each problem.
+
+    With a profiler (a profiling.Profiler), the calls to A, A^H and the
+    proximal operators are counted and timed; operators wrapped with the same
+    profiler before being stacked into A show up on their own as well.
     """
+    A, prox_f, prox_g = _profile_solver(profiler, A, prox_f=prox_f, prox_g=prox_g)
     x = x0
     y = y0
     z = x0
+    monitor = tol is not None or return_info
+    gap = f is not None and g is not None and f_conj is not None and g_conj is not None
+    info = _convergence_record()
+    start_time = time.perf_counter()
     if verbose:
         loop = tqdm(range(max_iter))
     else:
         loop = range(max_iter)
     for i in loop:
-        v = y + sigma * A @ z 
-        y = v - prox_g(v, sigma)
+        Az = A @ z
+        v = y + sigma * Az
+        # prox of sigma g* by the Moreau identity
+        y_prev = y
+        y = v - sigma * prox_g(v / sigma, 1 / sigma)
         x_prev = x
-        x = prox_f(x - tau * A.H * y, tau)
+        ATy = A.H @ y
+        x = prox_f(x - tau * ATy, tau)
+        info["iterations"] = i + 1
+        if monitor and _is_check(i, max_iter, check_every):
+            Ax = A @ x
+            residuals = {"primal_residual": np.linalg.norm(x_prev - x, axis=0) / tau,
+                         "dual_residual": np.linalg.norm((y_prev - y) / sigma - (Ax - Az), axis=0)}
+            if gap:
+                residuals["gap"] = f(x) + g(Ax) + f_conj(-ATy) + g_conj(y)
+            if _check_convergence(info, i, tol, residuals, tol_reference):
+                break
         z = x + theta*(x - x_prev)
+    info["time"] = time.perf_counter() - start_time
+    if return_info:
+        return x, info
+    return x
+
+def PDHG_inplace(prox_f, prox_g, A,
+                 x0, y0,
+                 sigma, tau, theta,
+                 max_iter=50,
+                 verbose=True,
+                 dtype=None,
+                 tol=None, check_every=10, return_info=False, profiler=None, tol_reference=None):
+    """
+    Solve
+
+        argmin_x f(x) + g(Ax)
+
+    with the same iteration as PDHG, but updating preallocated primal and dual
+    buffers in place. The proximal operators are called as prox(v, l, out) and
+    must write their result into out, which can be v itself. Apart from the
+    arrays returned by A and the residual checks, no memory is allocated during
+    the iterations.
+
+    dtype sets the type of the buffers (float32 halves the memory traffic);
+    by default it is the type of x0 and y0. tol, check_every, return_info,
+    profiler, tol_reference and batches of problems given as columns work as
+    in PDHG.
+    """
+    A, prox_f, prox_g = _profile_solver(profiler, A, prox_f=prox_f, prox_g=prox_g)
+    if dtype is None:
+        dtype = np.result_type(x0, y0)
+    x = np.array(x0, dtype=dtype)
+    y = np.array(y0, dtype=dtype)
+    z = x.copy()
+    x_prev = np.empty_like(x)
+    v = np.empty_like(y)
+    sigma, tau, theta = (np.dtype(dtype).type(c) for c in (sigma, tau, theta))
+    monitor = tol is not None or return_info
+    if monitor:
+        y_prev = np.empty_like(y)
+    info = _convergence_record()
+    start_time = time.perf_counter()
+
+    if verbose:
+        loop = tqdm(range(max_iter))
+    else:
+        loop = range(max_iter)
+    for i in loop:
+        check = monitor and _is_check(i, max_iter, check_every)
+        if check:
+            np.copyto(y_prev, y)
+        # v = y + sigma * A z
+        Az = A @ z
+        np.multiply(Az, sigma, out=v)
+        v += y
+        # y = v - sigma * prox_g(v / sigma, 1 / sigma)
+        np.divide(v, sigma, out=y)
+        prox_g(y, 1 / sigma, y)
+        y *= sigma
+        np.subtract(v, y, out=y)
+        # x = prox_f(x - tau * A^H y)
+        np.copyto(x_prev, x)
+        ATy = A.H @ y
+        np.multiply(ATy, tau, out=ATy, casting="unsafe")
+        np.subtract(x, ATy, out=x, casting="unsafe")
+        prox_f(x, tau, x)
+        info["iterations"] = i + 1
+        if check:
+            residuals = {"primal_residual": np.linalg.norm(x_prev - x, axis=0) / tau,
+                         "dual_residual": np.linalg.norm((y_prev - y) / sigma - (A @ x - Az), axis=0)}
+            if _check_convergence(info, i, tol, residuals, tol_reference):
+                break
+        # z = x + theta * (x - x_prev)
+        np.subtract(x, x_prev, out=z)
+        z *= theta
+        z += x
+    info["time"] = time.perf_counter() - start_time
+    if return_info:
+        return x, info
     return x
 
-def GFB(grad_f, prox_g, z, l, m, max_iter=50, verbose=True, f=None, g=None):
+def _iterate_history(keep_last):
+    # x is a new array at every iteration, so kept iterates need no copy
+    if keep_last:
+        return deque(maxlen=keep_last)
+    return []
+
+
+def _prox_pool(n_threads, n_regs):
+    if n_threads is None:
+        n_threads = min(n_regs, os.cpu_count() or 1)
+    if n_threads > 1 and n_regs > 1:
+        return ThreadPoolExecutor(n_threads)
+    return None
+
+
+def _GFB_update(grad_f, prox_g, z, x, l, m, pool):
+    # one update of all the rows of z, in place; the gradient is shared by
+    # the prox updates, which are independent
+    n_regs = z.shape[0]
+    w = 2*x - m*grad_f(x)
+
+    def update(j):
+        r = prox_g[j](w - z[j, :], m*n_regs)
+        r -= x
+        r *= l
+        z[j, :] += r
+
+    if pool is None:
+        for j in range(n_regs):
+            update(j)
+    else:
+        list(pool.map(update, range(n_regs)))
+
+
+def GFB(grad_f, prox_g, z, l, m, max_iter=50, verbose=True, f=None, g=None,
+        keep_every=None, keep_last=None, callback=None, n_threads=None, profiler=None):
     """
     Solve
     
@@ -86,7 +445,22 @@ def GFB(grad_f, prox_g, z, l, m, max_iter=50, verbose=True, f=None, g=None):
 
     given the gradient of f and the proximal operators of g_i
     using Generalised Forward Backward splitting
+
+    Returns x, the values of f and g at each iteration (if given) and the
+    iterates kept by the history policy: none by default, every keep_every-th
+    iterate, and/or only the keep_last most recent ones. callback(i, x) is
+    called with every iterate instead, e.g. to stream them to disk.
+
+    grad_f is evaluated once per iteration and the prox updates of the rows
+    of z, which are independent, are written in place by n_threads threads
+    (by default one per g_i, up to the number of CPUs; 1 runs them
+    sequentially); the proximal operators must then be safe to call
+    concurrently.
+
+    profiler records the calls to grad_f and to every prox_g[i]; the times
+    of proximal operators running in parallel overlap.
     """
+    _, grad_f, prox_g = _profile_solver(profiler, grad_f=grad_f, prox_g=prox_g)
     x = np.average(z, axis=0)
     n_regs = z.shape[0]
     if verbose:
@@ -96,20 +470,27 @@ def GFB(grad_f, prox_g, z, l, m, max_iter=50, verbose=True, f=None, g=None):
 
     res_f = []
     res_g = []
-    xs = []
+    xs = _iterate_history(keep_last)
+    pool = _prox_pool(n_threads, n_regs)
     for i in loop:
-        for j in range(n_regs):
-            z[j, :] = z[j, :] + l*(prox_g[j](2*x - z[j, :] - m*grad_f(x), m*n_regs) - x)
+        _GFB_update(grad_f, prox_g, z, x, l, m, pool)
         x = np.average(z, axis=0)
-        xs.append(x)
+        if keep_last or keep_every:
+            if not keep_every or (i + 1) % keep_every == 0:
+                xs.append(x)
+        if callback is not None:
+            callback(i, x)
         if not f is None:
-            res_f.append(f(x))
+            res_f.append(float(f(x)))
         if not g is None:
-            res_g.append([g[i](z[i]) for i in range(len(g))])
-    return x, res_f, np.array(res_g), xs
+            res_g.append([float(g[i](z[i])) for i in range(len(g))])
+    if pool is not None:
+        pool.shutdown()
+    return x, res_f, np.array(res_g), list(xs)
 
 
-def projected_GFB(grad_f, prox_g, z, l, m, bounds, max_iter=50, verbose=True, f=None, g=None):
+def projected_GFB(grad_f, prox_g, z, l, m, bounds, max_iter=50, verbose=True, f=None, g=None,
+                  keep_every=None, keep_last=None, callback=None, n_threads=None, profiler=None):
     """
     Solve
     
@@ -119,7 +500,11 @@ def projected_GFB(grad_f, prox_g, z, l, m, bounds, max_iter=50, verbose=True, f=
     given the gradient of f and the proximal operators of g_i
     using Generalised Forward Backward splitting and projecting
     in the bounds after each update
+
+    The history of the iterates, the threads and the profiler are controlled
+    as in GFB.
     """
+    _, grad_f, prox_g = _profile_solver(profiler, grad_f=grad_f, prox_g=prox_g)
     x = np.average(z, axis=0)
     n_regs = z.shape[0]
     if verbose:
@@ -129,18 +514,65 @@ def projected_GFB(grad_f, prox_g, z, l, m, bounds, max_iter=50, verbose=True, f=
 
     res_f = []
     res_g = []
-    xs = []
+    xs = _iterate_history(keep_last)
+    pool = _prox_pool(n_threads, n_regs)
     for i in loop:
-        for j in range(n_regs):
-            z[j, :] = z[j, :] + l*(prox_g[j](2*x - z[j, :] - m*grad_f(x), m*n_regs) - x)
-        z = np.clip(z, *bounds)
+        _GFB_update(grad_f, prox_g, z, x, l, m, pool)
+        np.clip(z, *bounds, out=z)
         x = np.average(z, axis=0)
-        xs.append(x)
+        if keep_last or keep_every:
+            if not keep_every or (i + 1) % keep_every == 0:
+                xs.append(x)
+        if callback is not None:
+            callback(i, x)
         if not f is None:
-            res_f.append(f(x))
+            res_f.append(float(f(x)))
         if not g is None:
-            res_g.append([g[i](z[i]) for i in range(len(g))])
-    return x, res_f, np.array(res_g), xs
+            res_g.append([float(g[i](z[i])) for i in range(len(g))])
+    if pool is not None:
+        pool.shutdown()
+    return x, res_f, np.array(res_g), list(xs)
+
+
+def tv_pair_proxes(shape, a, dtype=np.float64):
+    """
+    Proximal operators of a*||G_i x||_1 for the semi-orthogonal splitting of
+    the gradient of an array of the given shape into its even and odd
+    differences along every axis (4 operators in 2D, 6 in 3D), in the order
+    even x, even y, (even z,) odd x, odd y, (odd z), where x is the last axis.
+    They take flat vectors and may overwrite their input.
+
+    Their work buffers are allocated in dtype, the type of the iterates, and
+    once more for every other type they are called with.
+    """
+    proxes = []
+    for parity in (0, 1):
+        for axis in reversed(range(len(shape))):
+            pairs = list(shape)
+            pairs[axis] = (shape[axis] - parity) // 2
+            works = {np.dtype(dtype): np.empty(pairs, dtype=dtype)}
+
+            def prox(v, l, axis=axis, parity=parity, pairs=pairs, works=works):
+                work = works.get(v.dtype)
+                if work is None:
+                    work = works[v.dtype] = np.empty(pairs, dtype=v.dtype)
+                volume = v.reshape(shape)
+                return prox_l1_pairs_inplace(volume, a*l, axis, parity, volume, work).ravel()
+            proxes.append(prox)
+    return proxes
+
+
+def _TV_min_GFB(grad_f, a, x0, l, m, bounds, projected, max_iter, verbose):
+    prox_g = tv_pair_proxes(x0.shape, a, x0.dtype)
+    if bounds is not None and not projected:
+        prox_g.append(lambda v, l: prox_box(v, l, bounds))
+
+    z = np.repeat(x0.ravel()[np.newaxis], len(prox_g), axis=0)
+    if bounds is None or not projected:
+        rec = GFB(grad_f, prox_g, z, l, m, max_iter=max_iter, verbose=verbose)[0]
+    else:
+        rec = projected_GFB(grad_f, prox_g, z, l, m, bounds=bounds, max_iter=max_iter, verbose=verbose)[0]
+    return rec.reshape(x0.shape)
 
 
 def TV_min_2D_GFB(grad_f, a, x0, l, m, bounds=None, max_iter=50, verbose=True):
@@ -160,26 +592,7 @@ def TV_min_2D_GFB(grad_f, a, x0, l, m, bounds=None, max_iter=50, verbose=True):
 
     which is solved using the same method.
     """
-
-    # semi orthogonal splitting of gradient operator
-    G1 = even_gradient_x(x0.shape[0])
-    G2 = even_gradient_y(x0.shape[0])
-    G3 = odd_gradient_x(x0.shape[0])
-    G4 = odd_gradient_y(x0.shape[0])
-
-    # the proximal operators of ||G_i x||_1
-    prox_g1 = lambda v, l: prox_f_semi_orthogonal(prox_l1, 2**(-0.5)*G1, v, a*2**(0.5)*l)
-    prox_g2 = lambda v, l: prox_f_semi_orthogonal(prox_l1, 2**(-0.5)*G2, v, a*2**(0.5)*l)
-    prox_g3 = lambda v, l: prox_f_semi_orthogonal(prox_l1, 2**(-0.5)*G3, v, a*2**(0.5)*l)
-    prox_g4 = lambda v, l: prox_f_semi_orthogonal(prox_l1, 2**(-0.5)*G4, v, a*2**(0.5)*l)
-    prox_g = [prox_g1, prox_g2, prox_g3, prox_g4]
-    if bounds is not None:
-        prox_g5 = lambda v, l: prox_box(v, l, bounds)
-        prox_g.append(prox_g5)
-
-    z = np.repeat(x0.ravel()[np.newaxis], len(prox_g), axis=0)
-    rec = GFB(grad_f, prox_g, z, l, m, max_iter=max_iter, verbose=verbose)[0]
-    return rec.reshape(x0.shape)
+    return _TV_min_GFB(grad_f, a, x0, l, m, bounds, False, max_iter, verbose)
 
 
 def TV_min_2D_projected_GFB(grad_f, a, x0, l, m, bounds=None, max_iter=50, verbose=True):
@@ -200,26 +613,77 @@ def TV_min_2D_projected_GFB(grad_f, a, x0, l, m, bounds=None, max_iter=50, verbo
 
     which is solved using projected_GFB
     """
+    return _TV_min_GFB(grad_f, a, x0, l, m, bounds, True, max_iter, verbose)
 
-    # semi orthogonal splitting of gradient operator
-    G1 = even_gradient_x(x0.shape[0])
-    G2 = even_gradient_y(x0.shape[0])
-    G3 = odd_gradient_x(x0.shape[0])
-    G4 = odd_gradient_y(x0.shape[0])
 
-    # the proximal operators of ||G_i x||_1
-    prox_g1 = lambda v, l: prox_f_semi_orthogonal(prox_l1, 2**(-0.5)*G1, v, a*2**(0.5)*l)
-    prox_g2 = lambda v, l: prox_f_semi_orthogonal(prox_l1, 2**(-0.5)*G2, v, a*2**(0.5)*l)
-    prox_g3 = lambda v, l: prox_f_semi_orthogonal(prox_l1, 2**(-0.5)*G3, v, a*2**(0.5)*l)
-    prox_g4 = lambda v, l: prox_f_semi_orthogonal(prox_l1, 2**(-0.5)*G4, v, a*2**(0.5)*l)
-    prox_g = [prox_g1, prox_g2, prox_g3, prox_g4]
-    
-    z = np.repeat(x0.ravel()[np.newaxis], len(prox_g), axis=0)
-    if bounds is None:
-        rec = GFB(grad_f, prox_g, z, l, m, max_iter=max_iter, verbose=verbose)[0]
+def TV_min_3D_GFB(grad_f, a, x0, l, m, bounds=None, max_iter=50, verbose=True):
+    """
+    Solve
+
+        argmin_x f(x) + a*||grad x||_1
+
+    for a 3D volume x, as TV_min_2D_GFB, with the gradient split into
+    the even and odd differences along each of the three axes.
+    """
+    return _TV_min_GFB(grad_f, a, x0, l, m, bounds, False, max_iter, verbose)
+
+
+def TV_min_3D_projected_GFB(grad_f, a, x0, l, m, bounds=None, max_iter=50, verbose=True):
+    """
+    Solve
+
+        argmin_x f(x) + a*||grad x||_1
+        such that x in bounds
+
+    for a 3D volume x, as TV_min_2D_projected_GFB.
+    """
+    return _TV_min_GFB(grad_f, a, x0, l, m, bounds, True, max_iter, verbose)
+
+
+def sirt_weights(A):
+    """
+    Inverse row and column sums of a nonnegative linear operator A, the
+    weights R and C of SIRT (0 for empty rows and columns)
+    """
+    row_sums = A @ np.ones(A.shape[1], dtype=A.dtype)
+    col_sums = A.H @ np.ones(A.shape[0], dtype=A.dtype)
+    with np.errstate(divide="ignore"):
+        R = np.where(row_sums > 0, 1/row_sums, 0)
+        C = np.where(col_sums > 0, 1/col_sums, 0)
+    return R, C
+
+
+def SIRT(A, b, x0=None, max_iter=10, bounds=None, weights=None, verbose=False):
+    """
+    Solve
+
+        argmin_x ||Ax - b||_R^2
+
+    for a nonnegative linear operator A using the Simultaneous Iterative
+    Reconstruction Technique, x <- x + C A^H R (b - Ax), where R and C are
+    the inverse row and column sums of A. One iteration from zero is the
+    normalized backprojection C A^H R b.
+
+    x is clipped to bounds after every iteration if they are given; weights
+    are the (R, C) of sirt_weights, computed if None. Problems that share A
+    can be solved together as the columns of b (and x0).
+    """
+    if weights is None:
+        weights = sirt_weights(A)
+    R, C = weights
+    if b.ndim == 2:
+        R = R[:, np.newaxis]
+        C = C[:, np.newaxis]
+    x = np.zeros((A.shape[1],) + b.shape[1:], dtype=b.dtype) if x0 is None else x0
+    if verbose:
+        loop = tqdm(range(max_iter))
     else:
-        rec = projected_GFB(grad_f, prox_g, z, l, m, bounds=bounds, max_iter=max_iter, verbose=verbose)[0]
-    return rec.reshape(x0.shape)
+        loop = range(max_iter)
+    for i in loop:
+        x = x + C * (A.H @ (R * (b - A @ x)))
+        if bounds is not None:
+            x = np.clip(x, *bounds)
+    return x
 
 
 def operator_2norm(A, max_iter):
@@ -230,9 +694,131 @@ def operator_2norm(A, max_iter):
         B = A.H @ A
     else:
         B = A.T @ A
-    b = np.random.normal(0,1,B.shape[1])
+    b = np.random.normal(0,1,B.shape[1]).astype(A.dtype)
     b = b/np.linalg.norm(b)
     for i in range(max_iter):
         b = B @ b
         b = b/np.linalg.norm(b)
-    return np.sqrt(np.linalg.norm(B@b)/np.linalg.norm(b))
\ No newline at end of file
+    return np.sqrt(np.linalg.norm(B@b)/np.linalg.norm(b))
+
+
+def estimate_operator_2norm(A, tol=1e-4, max_iter=100, method="power", seed=0):
+    """
+    Estimate the 2-norm of a linear operator from the largest eigenvalue of A^H A
+
+    The power method stops as soon as the relative change of the eigenvalue estimate
+    is below tol; method="lanczos" uses the Lanczos iteration of eigsh instead.
+    Returns the estimate and a bound on its error: for the final unit vector b and
+    eigenvalue estimate l = <b, A^H A b>, some eigenvalue of A^H A lies within
+    ||A^H A b - l b|| of l, which translates to the returned bound on the norm.
+    """
+    if hasattr(A, "adjoint"):
+        B = A.H @ A
+    else:
+        B = A.T @ A
+    b = np.random.default_rng(seed).normal(0, 1, B.shape[1]).astype(A.dtype)
+    b = b/np.linalg.norm(b)
+
+    if method == "lanczos":
+        l, v = eigsh(B, k=1, which="LM", tol=tol, maxiter=max_iter, v0=b)
+        b = v[:, 0]/np.linalg.norm(v[:, 0])
+        Bb = B @ b
+        iterations = None
+    elif method == "power":
+        Bb = B @ b
+        l_prev = 0
+        for iterations in range(1, max_iter + 1):
+            l = np.linalg.norm(Bb)
+            if abs(l - l_prev) <= tol*l:
+                break
+            l_prev = l
+            b = Bb/l
+            Bb = B @ b
+    else:
+        raise ValueError("unknown method {}".format(method))
+
+    rayleigh = np.dot(b, Bb)
+    norm = np.sqrt(np.linalg.norm(Bb))
+    bound = np.linalg.norm(Bb - rayleigh*b)/max(np.sqrt(rayleigh), np.finfo(float).tiny)
+    return norm, bound, iterations
+
+
+def operator_fingerprint(shape, **params):
+    """
+    Key identifying an operator by its shape and the parameters it was built from
+    """
+    description = json.dumps(dict(params, shape=list(shape)), sort_keys=True, default=str)
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+def norm_cache_dir():
+    return os.environ.get("LAMINO_CACHE_DIR",
+                          os.path.join(os.path.expanduser("~"), ".cache", "lamino-set-generator"))
+
+
+def cached_operator_2norm(A, fingerprint, cache_dir=None, tol=1e-4, **kwargs):
+    """
+    estimate_operator_2norm, memoized on disk under the operator fingerprint
+
+    A cached estimate is reused when it was computed with a tolerance at least as tight
+    as tol. Returns the estimate and its error bound.
+    """
+    if cache_dir is None:
+        cache_dir = norm_cache_dir()
+    path = os.path.join(cache_dir, "opnorm_{}.json".format(fingerprint))
+
+    if os.path.isfile(path):
+        with open(path) as f:
+            entry = json.load(f)
+        if entry["tol"] <= tol:
+            return entry["norm"], entry["bound"]
+
+    norm, bound, iterations = estimate_operator_2norm(A, tol=tol, **kwargs)
+
+    # written to a temporary file first, so that concurrent jobs never read a partial entry
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump({"norm": float(norm), "bound": float(bound), "tol": tol, "iterations": iterations}, f)
+    os.replace(tmp_path, path)
+
+    return norm, bound
+
+
+if __name__ == "__main__":
+    # The dual step y = v - sigma*prox_g(v/sigma, 1/sigma) is the prox of
+    # sigma g*. The former step y = v - prox_g(v, sigma) is the same step for
+    # h(u) = g(sigma u), whose prox is prox_g(sigma v, l sigma^2)/sigma, so
+    # PDHG and PDHG_inplace on h must reproduce the former iterates on g (with
+    # sigma = 1, h is g and both steps coincide).
+    from scipy.sparse.linalg import aslinearoperator
+    from proximal_operators import prox_l1
+
+    def PDHG_former(prox_f, prox_g, A, x0, y0, sigma, tau, theta, max_iter):
+        x, y, z = x0, y0, x0
+        for i in range(max_iter):
+            v = y + sigma * (A @ z)
+            y = v - prox_g(v, sigma)
+            x_prev = x
+            x = prox_f(x - tau * (A.H @ y), tau)
+            z = x + theta*(x - x_prev)
+        return x
+
+    rng = np.random.default_rng(0)
+    A = aslinearoperator(rng.normal(size=(60, 40)))
+    b = rng.normal(size=60)
+    prox_f = lambda v, l: prox_box(v, l, (0, None))
+    prox_g = lambda v, l: b + prox_l1(v - b, l)
+    x0, y0 = np.zeros(40), np.zeros(60)
+    step = 0.9 / operator_2norm(A, 50)
+    for sigma in (1.0, step, 3 * step):
+        tau = step ** 2 / sigma
+        prox_h = lambda v, l: prox_g(sigma * v, l * sigma ** 2) / sigma
+        former = PDHG_former(prox_f, prox_g, A, x0, y0, sigma, tau, 1, 200)
+        x = PDHG(prox_f, prox_h, A, x0, y0, sigma, tau, 1, 200, verbose=False)
+        x_inplace = PDHG_inplace(lambda v, l, out: np.copyto(out, prox_f(v, l)),
+                                 lambda v, l, out: np.copyto(out, prox_h(v, l)),
+                                 A, x0, y0, sigma, tau, 1, 200, verbose=False)
+        print("sigma {:.3f}: relative difference to the former dual step {:.1e} (PDHG), {:.1e} (PDHG_inplace)".format(
+            sigma, np.linalg.norm(x - former) / np.linalg.norm(former),
+            np.linalg.norm(x_inplace - former) / np.linalg.norm(former)))
@@ -1,39 +1,290 @@
-from imageio import imread, imwrite
-from object_scan import ScanningObject
+from imageio import imwrite
+from object_scan import ScanningObject, geometry_cache
+from volume_store import VolumeStore, VolumeStoreWriter, is_volume_store, read_png_volume, png_scale
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import argparse
+import glob
 import os
+import re
+import shutil
+import threading
+import time
+import zlib
 import numpy as np
 
 import pandas as pd
 
-projs = 100
 
-data_src = "D:\\Datasets\\demo_data_plates\\"
-data_dest0 = "D:\\Datasets\\demo_plates_{}_projs\\".format(projs)
-data_dest = "D:\\Datasets\\demo_plates_{}_projs\\input-TV\\".format(projs)
+class StageStats:
+    """
+    This class accumulates the number of samples and the busy time of every stage of the pipeline.
+    """
 
-if not os.path.isdir(data_dest):
-    #os.mkdir(data_dest0)
-    os.mkdir(data_dest)
+    def __init__(self):
+        self.samples = {}
+        self.seconds = {}
+        # the reader threads add their times concurrently
+        self.lock = threading.Lock()
 
-set = pd.read_csv("test2.csv")
+    def add(self, stage, samples, seconds):
+        with self.lock:
+            self.samples[stage] = self.samples.get(stage, 0) + samples
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
 
-for folder in os.listdir(data_src):
+    def report(self, elapsed_time):
+        for stage in self.samples:
+            print("{:12s} {:6d} samples in {:8.1f} s ({:.2f} samples/s)".format(
+                stage, self.samples[stage], self.seconds[stage],
+                self.samples[stage] / max(self.seconds[stage], 1e-9)))
+        total = self.samples.get('write', 0)
+        print("{:12s} {:6d} samples in {:8.1f} s ({:.2f} samples/s)".format(
+            'total', total, elapsed_time, total / max(elapsed_time, 1e-9)))
 
-    if set.iloc[:,0].str.contains(folder).any():
-        print(folder)
-        plane = np.zeros((10, 128, 128))
-        k = 0
-        for file in os.listdir(data_src+folder):
-            i = imread(data_src + folder + "\\" + file, pilmode='F')
-            plane[k, :, :] = i
-            k = k + 1
 
-        setup = ScanningObject(alpha_param=30, n_cells_param=256, n_proj_param=projs, rec_size_param=128)
-        out = setup.run(plane, rec_algorithm_param='TV3D')
+def read_sample(source, data_src, name, dtype=np.float64):
+    """
+    It reads a plate from a VolumeStore, or from its folder of PNG slices ordered by slice index, as an array of type
+    dtype. Both hold the 0..255 values that run and run_batch expect.
+    """
+    if source is not None:
+        return np.array(source[name], dtype=dtype)
+    return read_png_volume(os.path.join(data_src, name)).astype(dtype, copy=False)
 
-        if not os.path.isdir(data_dest+folder):
-            os.mkdir(data_dest+folder)
 
-        for k in range(10):
-            imwrite(data_dest+folder+"\\slice_{}.png".format(k), out['rec'][k,:,:])
+def write_png_sample(data_dest, name, rec):
+    """
+    It writes a reconstruction as one PNG per slice. The slices are written to a temporary folder that is renamed
+    once complete, so that a folder in data_dest is always a finished sample.
+    """
+    folder = os.path.join(data_dest, name)
+    tmp_folder = folder + ".tmp"
+    if os.path.isdir(tmp_folder):
+        shutil.rmtree(tmp_folder)
+    os.mkdir(tmp_folder)
+    for k in range(rec.shape[0]):
+        imwrite(os.path.join(tmp_folder, "slice_{}.png".format(k)), rec[k, :, :])
+    os.replace(tmp_folder, folder)
 
+
+def sample_name(entry):
+    """
+    It reduces a manifest entry, which can be a sample name or a path to it, to the sample name.
+    """
+    return re.split(r"[\\/]", str(entry).strip().rstrip("\\/"))[-1]
+
+
+def read_manifest(path):
+    """
+    It loads the sample names of the first column of a CSV manifest into a set, for exact matching. The manifest has
+    no header row, and the names are read as strings so that numeric names keep their leading zeros.
+    """
+    entries = pd.read_csv(path, header=None, usecols=[0], dtype=str).iloc[:, 0]
+    return set(sample_name(entry) for entry in entries.dropna())
+
+
+def parse_shard(shard):
+    """
+    It parses a shard given as "i/n", with 0 <= i < n.
+    """
+    i, n = (int(k) for k in shard.split("/"))
+    if not 0 <= i < n:
+        raise ValueError("invalid shard {}".format(shard))
+    return i, n
+
+
+def in_shard(name, shard, n_shards):
+    # crc32 rather than hash(), which is salted differently in every process
+    return zlib.crc32(name.encode()) % n_shards == shard
+
+
+def completion_manifest(data_dest, shard, n_shards):
+    return os.path.join(data_dest, "completed_shard_{}_of_{}.txt".format(shard, n_shards))
+
+
+def read_completed(path):
+    if not os.path.isfile(path):
+        return set()
+    with open(path) as manifest:
+        return set(line.strip() for line in manifest if line.strip())
+
+
+def merge_completion_manifests(data_dest, path=None):
+    """
+    It merges the completion manifests of all the shards in data_dest into one sorted list of sample names.
+    :param path: file the merged list is written to (data_dest/completed.txt if None);
+    :return: the merged list.
+    """
+    if path is None:
+        path = os.path.join(data_dest, "completed.txt")
+    names = set()
+    for shard_manifest in glob.glob(os.path.join(data_dest, "completed_shard_*_of_*.txt")):
+        names |= read_completed(shard_manifest)
+    names = sorted(names)
+    with open(path, "w") as merged:
+        merged.writelines(name + "\n" for name in names)
+    return names
+
+
+def scan_dataset(data_src, data_dest, names, projs, batch_size=4, use_store=False, n_readers=2, prefetch=2,
+                 n_iterations=500, tol=1e-3, completed_path=None, levels=None, sirt_iterations=0,
+                 backend='astra', dtype=np.float64):
+    """
+    It reconstructs the plates with TV3D in a pipeline: a thread pool reads and decodes the next batches while the
+    current one is reconstructed, and a background thread writes the finished reconstructions. Samples that are
+    already in data_dest are skipped, so an interrupted run can simply be started again.
+    :param data_src: folder of PNG plates or VolumeStore;
+    :param data_dest: folder of the reconstructions, one folder of PNG slices per sample or a VolumeStore;
+    :param names: names of the samples to reconstruct;
+    :param projs: number of projections of the inline setup;
+    :param batch_size: plates reconstructed together in one solver run (the solver memory grows linearly with it);
+    :param use_store: if True, the reconstructions are appended to a VolumeStore in data_dest instead of PNGs;
+    :param n_readers: number of threads reading batches of plates; as at most prefetch batches are read at once, it
+    cannot exceed prefetch;
+    :param prefetch: number of batches read ahead of the reconstruction (and written behind it);
+    :param n_iterations: maximum number of TV3D iterations;
+    :param tol: TV3D residual tolerance;
+    :param completed_path: completion manifest to which the name of every written sample is appended;
+    :param levels: (binning, n_iterations, tol) levels of a multiresolution reconstruction (see
+    ScanningObject.solve_tv3d_multires), in place of n_iterations and tol;
+    :param sirt_iterations: number of SIRT iterations TV3D starts from (0 starts from zero, 1 from the normalized
+    backprojection);
+    :param backend: projection backend of ScanningObject ('astra', 'cpu' or 'sparse');
+    :param dtype: floating point type of the plates and of the TV3D solver buffers (np.float32 halves the memory
+    traffic of the iterations);
+    :return: the StageStats of the run.
+    """
+    if n_readers > prefetch:
+        raise ValueError("{} readers for {} prefetched batches, the others would stay idle".format(n_readers, prefetch))
+    source = VolumeStore(data_src) if is_volume_store(data_src) else None
+
+    if use_store:
+        writer = VolumeStoreWriter(data_dest, (10, 128, 128), len(names))
+        done = lambda name: name in writer
+    else:
+        if not os.path.isdir(data_dest):
+            os.makedirs(data_dest)
+        done = lambda name: os.path.isdir(os.path.join(data_dest, name))
+
+    pending = [name for name in names if not done(name)]
+    print("{} samples, {} already reconstructed".format(len(names), len(names) - len(pending)))
+    if completed_path is not None:
+        # samples finished before the manifest was written (or before a crash) are recorded as well
+        completed = read_completed(completed_path)
+        missing = [name for name in names if name not in completed and done(name)]
+        if missing:
+            with open(completed_path, 'a') as manifest:
+                manifest.writelines(name + "\n" for name in missing)
+    batches = [pending[first:first + batch_size] for first in range(0, len(pending), batch_size)]
+
+    stats = StageStats()
+    setup = ScanningObject(alpha_param=30, n_cells_param=256, n_proj_param=projs, rec_size_param=128,
+                           backend_param=backend)
+
+    def read(batch):
+        start_time = time.perf_counter()
+        planes = [read_sample(source, data_src, name, dtype) for name in batch]
+        stats.add('read', len(batch), time.perf_counter() - start_time)
+        return planes
+
+    def write(batch, outs):
+        start_time = time.perf_counter()
+        for name, out in zip(batch, outs):
+            if use_store:
+                writer.append(name, png_scale(out['rec']))
+            else:
+                write_png_sample(data_dest, name, out['rec'])
+        if use_store:
+            writer.flush()
+        if completed_path is not None:
+            with open(completed_path, 'a') as completed:
+                completed.writelines(name + "\n" for name in batch)
+                completed.flush()
+                os.fsync(completed.fileno())
+        stats.add('write', len(batch), time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(n_readers) as readers, ThreadPoolExecutor(1) as writers:
+        reads = deque(readers.submit(read, batch) for batch in batches[:prefetch])
+        writes = deque()
+        for i, batch in enumerate(batches):
+            planes = reads.popleft().result()
+            if i + prefetch < len(batches):
+                reads.append(readers.submit(read, batches[i + prefetch]))
+
+            rec_start_time = time.perf_counter()
+            outs = setup.run_batch(planes, n_iterations_param=n_iterations, dtype_param=dtype, tol_param=tol,
+                                   levels_param=levels, sirt_iterations_param=sirt_iterations)
+            stats.add('reconstruct', len(batch), time.perf_counter() - rec_start_time)
+            for name, out in zip(batch, outs):
+                info = out['info']
+                if info['converged']:
+                    print("{}: converged at iteration {}".format(name, info.get('converged_at', info['iterations'])))
+                else:
+                    print("{}: not converged after {} iterations".format(name, info['iterations']))
+
+            writes.append(writers.submit(write, batch, outs))
+            # errors of the writer surface here, and at most prefetch batches wait to be written
+            while writes and (writes[0].done() or len(writes) > prefetch):
+                writes.popleft().result()
+        while writes:
+            writes.popleft().result()
+
+    if use_store:
+        writer.close()
+    stats.report(time.perf_counter() - start_time)
+    return stats
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="TV3D reconstructions of the plates listed in a manifest")
+    parser.add_argument("--src", default="D:\\Datasets\\demo_data_plates\\",
+                        help="folder of PNG plates or VolumeStore")
+    parser.add_argument("--dest", default=None,
+                        help="folder of the reconstructions (D:\\Datasets\\demo_plates_<projs>_projs\\input-TV\\)")
+    parser.add_argument("--manifest", default="test2.csv", help="CSV whose first column lists the samples")
+    parser.add_argument("--projs", type=int, default=100, help="number of projections")
+    parser.add_argument("--shard", default="0/1", help="i/n: reconstruct only the i-th of n deterministic shards")
+    parser.add_argument("--store", action="store_true",
+                        help="append the reconstructions to a VolumeStore (one per shard) instead of PNGs")
+    parser.add_argument("--batch-size", type=int, default=4, help="plates reconstructed in one solver run")
+    parser.add_argument("--sirt-iterations", type=int, default=0,
+                        help="SIRT iterations TV3D starts from (1: normalized backprojection, 0: zero)")
+    parser.add_argument("--backend", default="astra", choices=("astra", "cpu", "sparse"),
+                        help="projector: ASTRA on the GPU, ConeVecProjector or the cached system matrix")
+    parser.add_argument("--float32", action="store_true",
+                        help="read the plates and run TV3D in single precision")
+    parser.add_argument("--merge", action="store_true", help="only merge the completion manifests of all shards")
+    args = parser.parse_args()
+
+    data_dest = args.dest
+    if data_dest is None:
+        data_dest = "D:\\Datasets\\demo_plates_{}_projs\\input-TV\\".format(args.projs)
+
+    if args.merge:
+        print("{} samples completed".format(len(merge_completion_manifests(data_dest))))
+    else:
+        shard, n_shards = parse_shard(args.shard)
+        selection = read_manifest(args.manifest)
+
+        if is_volume_store(args.src):
+            names = VolumeStore(args.src).names
+        else:
+            names = sorted(os.listdir(args.src))
+        names = [name for name in names if name in selection and in_shard(name, shard, n_shards)]
+
+        if not os.path.isdir(data_dest):
+            os.makedirs(data_dest)
+        completed_path = completion_manifest(data_dest, shard, n_shards)
+        # shards running at the same time cannot append to the same store
+        rec_dest = data_dest
+        if args.store and n_shards > 1:
+            rec_dest = os.path.join(data_dest, "shard_{}_of_{}".format(shard, n_shards))
+
+        scan_dataset(args.src, rec_dest, names, args.projs, batch_size=args.batch_size, use_store=args.store,
+                     completed_path=completed_path, sirt_iterations=args.sirt_iterations, backend=args.backend,
+                     dtype=np.float32 if args.float32 else np.float64)
+
+        # release the projectors shared by the reconstructions
+        geometry_cache.clear()
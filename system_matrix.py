@@ -0,0 +1,174 @@
+import os
+import hashlib
+import numpy as np
+import scipy.sparse
+from concurrent.futures import ThreadPoolExecutor
+from scipy.sparse.linalg import LinearOperator
+from cpu_projector import ConeVecProjector
+from proximal_solvers import operator_fingerprint, norm_cache_dir
+
+
+class SystemMatrix(LinearOperator):
+    """
+    This class is the projection operator of a 'cone_vec' geometry stored explicitly as a CSR matrix, for geometries
+    small enough for it, such as the 10x128x128 inline setup with a 256 x 256 detector. Its products are single sparse
+    matrix products, and the row and column sums of SIRT are computed once with the matrix.
+
+    The volume and the sinogram have the layouts of ConeVecProjector, whose rays and interpolation weights the matrix
+    holds. Several volumes are projected at once by applying the operator to a (voxels, volumes) matrix.
+    Attributes
+    ---------
+    matrix      : csr_matrix
+        It holds the system matrix, with the rays in sinogram order as rows and the voxels as columns;
+    matrix_T    : csr_matrix
+        It holds the transpose of the matrix, also in CSR format, as backprojections by the CSC view of the matrix are
+        much slower than projections;
+    vol_shape   : tuple
+        It holds the shape (slices, rows, cols) of the volume;
+    sino_shape  : tuple
+        It holds the shape (detector rows, projections, detector cols) of the sinogram;
+    Methods
+    -------
+    sirt_weights()
+        Returns the inverse row and column sums of the matrix.
+    """
+
+    def __init__(self, matrix, vol_shape, sino_shape):
+        """
+        It creates a new instance of the class SystemMatrix.
+        :param matrix: CSR system matrix;
+        :param vol_shape: shape (slices, rows, cols) of the volume;
+        :param sino_shape: shape (detector rows, projections, detector cols) of the sinogram;
+        """
+        self.matrix = matrix.tocsr()
+        self.matrix_T = self.matrix.T.tocsr()
+        self.vol_shape = tuple(vol_shape)
+        self.sino_shape = tuple(sino_shape)
+        self.shape = self.matrix.shape
+        self.dtype = self.matrix.dtype
+
+        row_sums = np.asarray(self.matrix.sum(axis=1)).ravel()
+        col_sums = np.asarray(self.matrix.sum(axis=0)).ravel()
+        with np.errstate(divide='ignore'):
+            self.R = np.where(row_sums > 0, 1 / row_sums, 0).astype(self.dtype)
+            self.C = np.where(col_sums > 0, 1 / col_sums, 0).astype(self.dtype)
+
+    def sirt_weights(self):
+        return self.R, self.C
+
+    # as in ConeVecProjector, the products are computed in the type of the weights: scipy would otherwise convert the
+    # whole matrix to the type of the vector at every product
+    def _matvec(self, x):
+        return self.matrix @ x.ravel().astype(self.dtype, copy=False)
+
+    def _rmatvec(self, y):
+        return self.matrix_T @ y.ravel().astype(self.dtype, copy=False)
+
+    def _matmat(self, X):
+        return self.matrix @ X.astype(self.dtype, copy=False)
+
+    def _rmatmat(self, Y):
+        return self.matrix_T @ Y.astype(self.dtype, copy=False)
+
+
+def build_system_matrix(vectors, det_rows, det_cols, vol_shape, voxel_size=(1, 1, 1), step=0.5, dtype=np.float32,
+                        n_threads=None):
+    """
+    It traces the rays of every projection with ConeVecProjector, n_threads projections at a time (os.cpu_count() if
+    None), and assembles them into the CSR matrix of the geometry, with its rows in sinogram order.
+    :return: the SystemMatrix.
+    """
+    projector = ConeVecProjector(vectors, det_rows, det_cols, vol_shape, step=step, batch_size=1, dtype=dtype,
+                                 voxel_size=voxel_size)
+    n_proj = projector.sino_shape[1]
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+
+    with ThreadPoolExecutor(n_threads) as pool:
+        blocks = list(pool.map(lambda p: projector.projection_matrix(p, p + 1), range(n_proj)))
+
+    # the blocks hold the rays projection after projection, the sinogram detector row after detector row
+    order = np.arange(projector.shape[0]).reshape(n_proj, det_rows, det_cols).transpose(1, 0, 2).ravel()
+    matrix = scipy.sparse.vstack(blocks, format='csr')[order]
+    return SystemMatrix(matrix, vol_shape, projector.sino_shape)
+
+
+def system_matrix_fingerprint(vectors, det_rows, det_cols, vol_shape, voxel_size=(1, 1, 1), step=0.5,
+                              dtype=np.float32):
+    vectors = np.ascontiguousarray(vectors, dtype=np.float64)
+    return operator_fingerprint((len(vectors) * det_rows * det_cols, int(np.prod(vol_shape))),
+                                operator='SystemMatrix', vectors=hashlib.sha1(vectors.tobytes()).hexdigest(),
+                                det_rows=det_rows, det_cols=det_cols, vol_shape=list(vol_shape),
+                                voxel_size=[float(v) for v in voxel_size], step=step, dtype=np.dtype(dtype).name)
+
+
+def load_system_matrix(vectors, det_rows, det_cols, vol_shape, voxel_size=(1, 1, 1), step=0.5, dtype=np.float32,
+                       cache_dir=None, n_threads=None):
+    """
+    build_system_matrix, memoized on disk as a compressed npz file named after the fingerprint of the geometry in
+    cache_dir (norm_cache_dir() if None).
+    :return: the SystemMatrix.
+    """
+    if cache_dir is None:
+        cache_dir = norm_cache_dir()
+    fingerprint = system_matrix_fingerprint(vectors, det_rows, det_cols, vol_shape, voxel_size, step, dtype)
+    path = os.path.join(cache_dir, "system_matrix_{}.npz".format(fingerprint))
+    sino_shape = (det_rows, len(vectors), det_cols)
+
+    if os.path.isfile(path):
+        return SystemMatrix(scipy.sparse.load_npz(path), vol_shape, sino_shape)
+
+    system_matrix = build_system_matrix(vectors, det_rows, det_cols, vol_shape, voxel_size, step, dtype, n_threads)
+
+    # written to a temporary file first, so that concurrent jobs never read a partial matrix
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        scipy.sparse.save_npz(f, system_matrix.matrix, compressed=True)
+    os.replace(tmp_path, path)
+
+    return system_matrix
+
+
+if __name__ == '__main__':
+    # build and load times, size, and product times against ConeVecProjector without and with its ray cache
+    import time
+    import tempfile
+    from cpu_projector import dot_test
+    from inline_setup_3D import InlineScanningSetup
+
+    for n_proj in (4, 20):
+        setup = InlineScanningSetup(alpha=30, detector_cells=256, number_of_projections=n_proj, object_size=128)
+        vectors = setup.get_geometry_matrix()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            start_time = time.time()
+            S = load_system_matrix(vectors, 256, 256, (10, 128, 128), cache_dir=cache_dir)
+            build_time = time.time() - start_time
+            start_time = time.time()
+            S = load_system_matrix(vectors, 256, 256, (10, 128, 128), cache_dir=cache_dir)
+            load_time = time.time() - start_time
+            size = sum(os.path.getsize(os.path.join(cache_dir, name)) for name in os.listdir(cache_dir))
+        nbytes = sum(m.data.nbytes + m.indices.nbytes + m.indptr.nbytes for m in (S.matrix, S.matrix_T))
+        print("{} projections: build {:.1f} s, load {:.1f} s, {:.0f} MB on disk, {:.0f} MB in memory".format(
+            n_proj, build_time, load_time, size / 1e6, nbytes / 1e6))
+
+        W = ConeVecProjector(vectors, 256, 256, (10, 128, 128))
+        x = np.random.default_rng(0).random(W.shape[1])
+        y = W @ x
+        print("  max difference {:.1e}, adjoint error {:.1e}".format(np.abs(S @ x - y).max() / np.abs(y).max(),
+                                                                    dot_test(S)))
+
+        for name, op in (("ConeVecProjector", W),
+                         ("cached rays", ConeVecProjector(vectors, 256, 256, (10, 128, 128), cache_rays=True)),
+                         ("SystemMatrix", S)):
+            op @ x
+            op.H @ y
+            start_time = time.time()
+            for i in range(5):
+                op @ x
+            forward_time = (time.time() - start_time) / 5
+            start_time = time.time()
+            for i in range(5):
+                op.H @ y
+            adjoint_time = (time.time() - start_time) / 5
+            print("  {:16s} forward {:.3f} s, adjoint {:.3f} s".format(name, forward_time, adjoint_time))
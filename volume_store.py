@@ -0,0 +1,240 @@
+import os
+import re
+import numpy as np
+from imageio import imread
+
+
+class VolumeStore:
+    """
+    This class gives read access to a dataset of equally shaped volumes kept in a single memory-mapped .npy file.
+    The volumes are on the 0..255 scale of the PNG slices, so that a sample reads the same from a store as from its
+    PNG folder (see png_scale).
+    Attributes
+    ----------
+    names   : list
+        It holds the name of every committed sample, in storage order;
+    shape   : tuple
+        It holds the shape of a single sample volume;
+    Methods
+    -------
+    get(name)
+        Returns the volume of a sample as a read-only view on the memory map.
+    """
+
+    data_file = "volumes.npy"
+    index_file = "index.txt"
+
+    def __init__(self, path):
+        """
+        It opens an existing store.
+        :param path: folder of the store;
+        """
+        self.path = path
+        self.data = np.load(os.path.join(path, self.data_file), mmap_mode='r')
+        self.names = read_index(path)
+        self.rows = {name: row for row, name in enumerate(self.names)}
+        self.shape = self.data.shape[1:]
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __iter__(self):
+        for row, name in enumerate(self.names):
+            yield name, self.data[row]
+
+    def get(self, name):
+        """
+        It provides zero-copy access to a sample.
+        :param name: name of the sample, or its row in the store;
+        :return: the sample volume as a view on the memory map.
+        """
+        if isinstance(name, str):
+            name = self.rows[name]
+        elif name >= len(self.names):
+            raise IndexError("row {} is not committed".format(name))
+        return self.data[name]
+
+
+def png_scale(volume, dtype=np.float32):
+    """
+    It converts a volume with values in [0, 1], as produced by the generators and the reconstructions, to the 0..255
+    scale of the PNG slices imwrite makes of it, which is the value convention of the stores. The values are not
+    rounded to integers as in the PNG slices.
+    :return: the scaled volume, of type dtype.
+    """
+    return (np.asarray(volume, dtype=np.float64) * 255).astype(dtype)
+
+
+class VolumeStoreWriter:
+    """
+    This class appends sample volumes to a store while they are generated. The .npy file is preallocated with a fixed
+    capacity; a sample only becomes visible to readers once its name is written to the index, which happens after the
+    data has been flushed to disk, so an interrupted run leaves a consistent store that can be reopened and continued.
+    Methods
+    -------
+    append(name, volume)
+        Writes a sample in the next free row.
+    flush()
+        Commits the samples appended since the last flush.
+    close()
+        Flushes and releases the memory map.
+    """
+
+    def __init__(self, path, sample_shape=None, capacity=None, dtype=np.float32, flush_every=64):
+        """
+        It creates a new store, or reopens an existing one for appending.
+        :param path: folder of the store;
+        :param sample_shape: shape of a single sample volume (only needed for a new store);
+        :param capacity: maximum number of samples (needed for a new store; an existing store is enlarged to it);
+        :param dtype: data type of the stored volumes (only used for a new store);
+        :param flush_every: number of appended samples after which they are committed automatically;
+        """
+        self.path = path
+        self.flush_every = flush_every
+        data_path = os.path.join(path, VolumeStore.data_file)
+
+        if os.path.isfile(data_path):
+            self.data = np.load(data_path, mmap_mode='r+')
+            self.names = read_index(path)
+            if capacity is not None and capacity > self.data.shape[0]:
+                self._grow(capacity)
+        else:
+            if sample_shape is None or capacity is None:
+                raise ValueError("sample_shape and capacity are needed to create a new store")
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.data = np.lib.format.open_memmap(data_path, mode='w+', dtype=dtype,
+                                                  shape=(capacity,) + tuple(sample_shape))
+            self.names = []
+            open(os.path.join(path, VolumeStore.index_file), 'w').close()
+
+        self.committed = len(self.names)
+        self.rows = set(self.names)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def append(self, name, volume):
+        """
+        It writes a sample in the next free row of the store.
+        :param name: unique name of the sample;
+        :param volume: sample volume, with the shape of the store;
+        :return: the row of the sample.
+        """
+        if name in self.rows:
+            raise ValueError("sample {} is already in the store".format(name))
+        if "\n" in name:
+            raise ValueError("sample names cannot contain line breaks")
+        row = len(self.names)
+        if row >= self.data.shape[0]:
+            raise ValueError("the store is full ({} samples)".format(self.data.shape[0]))
+
+        self.data[row] = volume
+        self.names.append(name)
+        self.rows.add(name)
+
+        if len(self.names) - self.committed >= self.flush_every:
+            self.flush()
+
+        return row
+
+    def _grow(self, capacity):
+        # the committed rows are copied into a larger file that replaces the current one
+        data_path = os.path.join(self.path, VolumeStore.data_file)
+        tmp_path = data_path + ".tmp"
+        data = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=self.data.dtype,
+                                         shape=(capacity,) + self.data.shape[1:])
+        data[:len(self.names)] = self.data[:len(self.names)]
+        data.flush()
+        del self.data
+        os.replace(tmp_path, data_path)
+        self.data = data
+
+    def flush(self):
+        """
+        It commits the appended samples: the data is flushed first and the index is extended afterwards.
+        """
+        if self.committed == len(self.names):
+            return
+        self.data.flush()
+        with open(os.path.join(self.path, VolumeStore.index_file), 'a') as index:
+            index.writelines(name + "\n" for name in self.names[self.committed:])
+            index.flush()
+            os.fsync(index.fileno())
+        self.committed = len(self.names)
+
+    def close(self):
+        if getattr(self, 'data', None) is None:
+            return
+        self.flush()
+        self.data = None
+
+
+def read_index(path):
+    with open(os.path.join(path, VolumeStore.index_file)) as index:
+        return [line.rstrip("\n") for line in index if line.strip()]
+
+
+def is_volume_store(path):
+    return os.path.isfile(os.path.join(path, VolumeStore.data_file))
+
+
+def slice_index(filename):
+    """
+    It extracts the slice number from a file name such as slice_7.png or slice_07.png.
+    """
+    numbers = re.findall(r"\d+", os.path.basename(filename))
+    if not numbers:
+        raise ValueError("no slice index in {}".format(filename))
+    return int(numbers[-1])
+
+
+def read_png_volume(folder, axis=0):
+    """
+    It reads a volume saved as one PNG per slice, ordering the slices by the index in their file names.
+    :param folder: folder holding the slices;
+    :param axis: axis of the volume along which the slices are stacked;
+    :return: the volume as a float ndarray.
+    """
+    files = sorted(os.listdir(folder), key=slice_index)
+    return np.stack([imread(os.path.join(folder, file), pilmode='F') for file in files], axis=axis)
+
+
+def store_from_png_folders(src, dest, axis=0, dtype=np.float32):
+    """
+    It converts a dataset stored as one folder of PNG slices per sample into a store.
+    :param src: folder holding one sub-folder per sample;
+    :param dest: folder of the new store;
+    :param axis: axis of the volumes along which the slices are stacked;
+    :param dtype: data type of the stored volumes;
+    """
+    folders = sorted(f for f in os.listdir(src) if os.path.isdir(os.path.join(src, f)))
+    if not folders:
+        raise ValueError("no sample folders in {}".format(src))
+
+    first = read_png_volume(os.path.join(src, folders[0]), axis=axis)
+    with VolumeStoreWriter(dest, first.shape, len(folders), dtype=dtype) as writer:
+        for folder in folders:
+            if folder not in writer:
+                writer.append(folder, read_png_volume(os.path.join(src, folder), axis=axis))
+
+
+if __name__ == "__main__":
+    import sys
+    # python volume_store.py <png dataset folder> <store folder> [slice axis]
+    store_from_png_folders(sys.argv[1], sys.argv[2], axis=int(sys.argv[3]) if len(sys.argv) > 3 else 0)